@@ -0,0 +1,138 @@
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import ConversationModel, MessageModel
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteBuffer:
+    """
+    Per-process write-behind queue for chat messages.
+
+    Consumers ``add`` unsaved ``MessageModel`` instances after fanning them out;
+    a background task persists them with ``bulk_create`` once ``batch_size``
+    messages are waiting or ``flush_interval`` seconds have passed. ``add``
+    blocks while ``max_pending`` messages are queued, which pushes back on the
+    sending connections instead of growing memory, and returns a future that
+    resolves to whether the message was saved. Messages are written in the
+    order they were added, so a connection can wait for just its own writes by
+    flushing until the future of its last message.
+
+    A batch whose ``bulk_create`` fails is saved again one message at a time,
+    so one bad row costs only itself; messages that still fail are logged and
+    counted in ``dropped``.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_pending):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.written = 0
+        self.dropped = 0
+        self._loop = None
+        self._queue = None
+        self._filled = None
+        self._worker = None
+        self._flushing = 0
+
+    async def add(self, message):
+        self._ensure_worker()
+        saved = self._loop.create_future()
+        await self._queue.put((message, saved))
+        if self._queue.qsize() >= self.batch_size:
+            self._filled.set()
+        return saved
+
+    async def flush(self, until=None):
+        """Write queued messages now; wait for the future ``until`` if given, otherwise for the whole queue."""
+        if self._queue is None or self._loop is not asyncio.get_running_loop():
+            return
+        # Messages added while the flush waits are written straight away too, not after flush_interval.
+        self._flushing += 1
+        self._filled.set()
+        try:
+            if until is None:
+                await self._queue.join()
+            elif until.get_loop() is self._loop:
+                await until
+        finally:
+            self._flushing -= 1
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            self._filled = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            if not self._flushing:
+                try:
+                    await asyncio.wait_for(self._filled.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._filled.clear()
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            messages = [message for message, _ in batch]
+            results = [False] * len(batch)
+            try:
+                try:
+                    await database_sync_to_async(self.write)(messages)
+                    results = [True] * len(batch)
+                except Exception as e:
+                    logger.error(f"Error writing {len(batch)} buffered messages, saving them one by one: {e}")
+                    results = await database_sync_to_async(self.write_each)(messages)
+            except Exception as e:
+                logger.error(f"Error writing {len(batch)} buffered messages: {e}")
+            finally:
+                for (_, saved), result in zip(batch, results):
+                    if not saved.done():
+                        saved.set_result(result)
+                    self._queue.task_done()
+
+    def write(self, messages):
+        with transaction.atomic():
+            if connection.features.can_return_rows_from_bulk_insert:
+                MessageModel.objects.bulk_create(messages)
+            else:
+                for message in messages:
+                    message.save()
+            ConversationModel.record_messages(messages)
+        self.written += len(messages)
+
+    def write_each(self, messages):
+        results = []
+        for message in messages:
+            # The rolled-back bulk_create may have handed out primary keys.
+            message.pk = None
+            message._state.adding = True
+            try:
+                with transaction.atomic():
+                    message.save()
+                    ConversationModel.record_message(message)
+            except Exception as e:
+                self.dropped += 1
+                logger.error(f"Dropped buffered message from user {message.sender_id} "
+                             f"to user {message.receiver_id}: {e}")
+                results.append(False)
+            else:
+                self.written += 1
+                results.append(True)
+        return results
+
+
+message_buffer = MessageWriteBuffer(
+    settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+    settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL,
+    settings.CHAT_WRITE_BEHIND_MAX_PENDING,
+)
@@ -1,19 +1,43 @@
-import json
+import asyncio
 import logging
 
-from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
-from .models import MessageModel
+from django.utils.dateparse import parse_datetime
+from flopProject.metrics import timed_db
+from . import presence
+from .buffer import message_buffer
+from .models import ConversationModel, MessageModel
+from .protocol import FrameConsumer
+from users.cache import user_cache
 from users.models import User
 
 logger = logging.getLogger(__name__)
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+def encode_cursor(message):
+    return f"{message.timestamp.isoformat()}|{message.id}"
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, message_id = str(cursor).rsplit('|', 1)
+        parsed = parse_datetime(timestamp)
+        if parsed is None:
+            raise ValueError
+        return parsed, int(message_id)
+    except ValueError:
+        raise ValueError(f"Invalid history cursor: {cursor}") from None
+
+
+class ChatConsumer(FrameConsumer):
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.user = self.scope['user']
+        # Future of the last message this connection handed to the write-behind buffer.
+        self.last_write = None
         if self.user.is_anonymous:
             await self.close()
         else:
@@ -32,78 +56,135 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        if self.last_write is not None:
+            # Only this connection's messages: the buffer is shared by every connection in the process.
+            await message_buffer.flush(self.last_write)
         logger.info(f"WebSocket disconnected for room '{self.room_name}' with code {close_code}")
 
-    async def receive(self, text_data):
-        logger.info(f"Received message: {text_data}")
+    async def receive_frame(self, content):
+        logger.debug("Received message: %s", content)
 
         try:
-            text_data_json = json.loads(text_data)
-            message_type = text_data_json['type']
-            sender_user = text_data_json['sender']
-            recipient_user = text_data_json['recipient']
+            message_type = content['type']
+            sender_user = content['sender']
+            recipient_user = content['recipient']
 
             sender = await self.get_user(sender_user)
             recipient = await self.get_user(recipient_user)
 
-            if message_type == 'get_users':
-                await self.process_messages(sender, recipient)
+            if message_type in ('get_users', 'get_history'):
+                await self.process_messages(
+                    sender,
+                    recipient,
+                    before=content.get('before'),
+                    page_size=content.get('page_size')
+                )
             elif message_type == 'chat_message':
-                message = text_data_json['message']
+                message = content['message']
                 if message and sender_user and recipient_user:
                     await self.send_chat_message(sender, recipient, message)
-                    await self.save_message(sender, recipient, message)
-                    await self.send_chat_notification(sender, recipient, message)
+                    # Offline recipients get the message from the notification replay when they reconnect.
+                    online = await presence.is_online(recipient.id)
+                    saved_message = await self.store_message(sender, recipient, message, notification_send=online)
+                    if online:
+                        await self.send_chat_notification(sender, recipient, saved_message)
             elif message_type == 'mark_as_read':
                 marked_as_read = await self.mark_messages_as_read(sender, recipient)
                 if marked_as_read:
-                    await self.send(text_data=json.dumps({
+                    await self.send_frame({
                         'type': 'messages_marked_as_read',
                         'sender': sender.username,
                         'recipient': recipient.username,
                         'is_read': True
-                    }))
+                    })
             elif message_type == 'call_notification':
                 await self.send_call_notification(sender, recipient)
 
         except Exception as e:
             logger.error(f"Error processing message: {e}")
 
-    @database_sync_to_async
-    def get_user(self, username):
-        logger.info(f"Fetching user: {username}")
-        return User.objects.get(username=username)
+    async def get_user(self, username):
+        user = user_cache.get_by_username(username)
+        if user is None:
+            user = await self.fetch_user(username)
+            user_cache.set(user)
+        return user
 
+    @timed_db
     @database_sync_to_async
-    def save_message(self, sender, recipient, content):
-        logger.info(f"Saving message from {sender} to {recipient}: {content}")
-        return MessageModel.objects.create(sender=sender, receiver=recipient, content=content)
+    def fetch_user(self, username):
+        logger.debug("Fetching user: %s", username)
+        return User.objects.get(username=username)
 
-    async def process_message(self, message):
-        try:
-            await self.send(json.dumps({
-                'message': message.content,
-                'sender': message.sender.username,
-                'avatar': message.sender.avatar.url if message.sender.avatar else None,
-                'recipient': message.receiver.username,
-                'is_read': message.is_read
-            }))
-        except Exception as e:
-            logger.error(f"Error fetching and sending messages: {e}")
+    async def store_message(self, sender, recipient, content, notification_send=True):
+        if settings.CHAT_WRITE_BEHIND:
+            message = MessageModel(sender=sender, receiver=recipient, content=content,
+                                   notification_send=notification_send)
+            self.last_write = await message_buffer.add(message)
+            return message
+        return await self.save_message(sender, recipient, content, notification_send)
 
-    async def process_messages(self, sender, recipient):
-        logger.info(f"Fetching messages between {sender} and {recipient}")
+    @timed_db
+    @database_sync_to_async
+    def save_message(self, sender, recipient, content, notification_send=True):
+        logger.debug("Saving message from %s to %s: %s", sender, recipient, content)
+        with transaction.atomic():
+            # The notification is published right after the insert, so flag it here rather than re-saving later.
+            message = MessageModel.objects.create(sender=sender, receiver=recipient, content=content,
+                                                  notification_send=notification_send)
+            ConversationModel.record_message(message)
+        return message
+
+    @timed_db
+    @database_sync_to_async
+    def get_history_page(self, sender, recipient, before=None, page_size=None):
+        page_size = min(int(page_size or settings.CHAT_HISTORY_PAGE_SIZE), settings.CHAT_HISTORY_MAX_PAGE_SIZE)
+        page_size = max(page_size, 1)
+        queryset = MessageModel.objects.filter(
+            (Q(sender=sender) & Q(receiver=recipient)) |
+            (Q(sender=recipient) & Q(receiver=sender))
+        ).only('id', 'sender_id', 'receiver_id', 'content', 'timestamp', 'is_read')
+        if before:
+            timestamp, message_id = decode_cursor(before)
+            queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+
+        page = list(queryset.order_by('-timestamp', '-id')[:page_size + 1])
+        next_cursor = encode_cursor(page[page_size - 1]) if len(page) > page_size else None
+        page = page[:page_size]
+        page.reverse()
+
+        # Rows marked read before the watermark existed still carry is_read=True.
+        watermarks = dict(ConversationModel.objects.filter(
+            Q(owner=sender, partner=recipient) | Q(owner=recipient, partner=sender)
+        ).values_list('owner_id', 'read_watermark'))
+        usernames = {user.id: user.username for user in (sender, recipient)}
+        avatars = {user.id: user.avatar.url if user.avatar else None for user in (sender, recipient)}
+        return [{
+            'id': message.id,
+            'message': message.content,
+            'sender': usernames[message.sender_id],
+            'avatar': avatars[message.sender_id],
+            'recipient': usernames[message.receiver_id],
+            'timestamp': message.timestamp.isoformat(),
+            'is_read': message.is_read or message.id <= watermarks.get(message.receiver_id, 0)
+        } for message in page], next_cursor
+
+    async def process_messages(self, sender, recipient, before=None, page_size=None):
+        logger.debug("Fetching messages between %s and %s before %s", sender, recipient, before)
         try:
-            async for message in MessageModel.objects.filter(
-                    (Q(sender=sender) & Q(receiver=recipient)) |
-                    (Q(sender=recipient) & Q(receiver=sender))
-            ).select_related('sender', 'receiver').order_by('timestamp'):
-                await self.process_message(message)
+            messages, next_cursor = await self.get_history_page(sender, recipient, before, page_size)
+            await self.send_frame({
+                'type': 'history',
+                'messages': messages,
+                'next_cursor': next_cursor
+            })
+        except ValueError as e:
+            await self.send_frame({'type': 'error', 'for': 'get_history', 'error': str(e)})
         except Exception as e:
             logger.error(f"Error processing messages: {e}")
 
     async def send_chat_message(self, sender, recipient, message):
-        logger.info(f"Sending chat message from {sender} to {recipient}: {message}")
+        logger.debug("Sending chat message from %s to %s: %s", sender, recipient, message)
         await self.channel_layer.group_send(
             self.room_group_name,
             {
@@ -123,45 +204,32 @@ class ChatConsumer(AsyncWebsocketConsumer):
         avatar = event['avatar']
         is_read = event['is_read']
 
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'message': message,
             'sender': sender,
             'avatar': avatar,
             'recipient': recipient,
             'is_read': is_read
-        }))
+        })
 
+    @timed_db
     @database_sync_to_async
     def mark_messages_as_read(self, sender, recipient):
-        logger.info(f"Marking messages as read between {sender} and {recipient}")
-        updated_count = MessageModel.objects.filter(sender=recipient, receiver=sender, is_read=False).update(
-            is_read=True)
-        return updated_count > 0
-
-    async def send_chat_notification(self, sender, recipient, notification_message):
-        message = await self.get_last_message(sender, recipient)
-        if not message.notification_send:
-            logger.info(f"Sending notification from {sender.username} to {recipient.username}: {notification_message}")
-            await self.channel_layer.group_send(
-                f"user_{recipient.username}",
-                {
-                    'type': 'send_notification',
-                    'sender_id': sender.id,
-                    'sender_avatar': sender.avatar.url if sender.avatar else None,
-                    'sender_username': sender.username,
-                    'notification': notification_message
-                }
-            )
-            await self.mark_notification_sent(message)
+        logger.debug("Marking messages as read between %s and %s", sender, recipient)
+        return ConversationModel.mark_read(sender, recipient)
 
-    @database_sync_to_async
-    def mark_notification_sent(self, message):
-        message.notification_send = True
-        message.save()
-
-    @database_sync_to_async
-    def get_last_message(self, sender, recipient):
-        return MessageModel.objects.filter(sender=sender, receiver=recipient).order_by('-timestamp').first()
+    async def send_chat_notification(self, sender, recipient, message):
+        logger.debug("Sending notification from %s to %s: %s", sender.username, recipient.username, message.content)
+        await self.channel_layer.group_send(
+            f"user_{recipient.username}",
+            {
+                'type': 'send_notification',
+                'sender_id': sender.id,
+                'sender_avatar': sender.avatar.url if sender.avatar else None,
+                'sender_username': sender.username,
+                'notification': message.content
+            }
+        )
 
     async def send_notification(self, event):
         notification = event['notification']
@@ -169,16 +237,19 @@ class ChatConsumer(AsyncWebsocketConsumer):
         sender_avatar = event['sender_avatar']
         sender_username = event['sender_username']
 
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'notification',
             'sender_id': sender_id,
             'sender_avatar': sender_avatar,
             'sender_username': sender_username,
             'notification': notification
-        }))
+        })
 
     async def send_call_notification(self, sender, recipient):
-        logger.info(f"Sending call notification from {sender.username} to {recipient.username}")
+        if not await presence.is_online(recipient.id):
+            logger.debug("Skipping call notification from %s: %s is offline", sender.username, recipient.username)
+            return
+        logger.debug("Sending call notification from %s to %s", sender.username, recipient.username)
         await self.channel_layer.group_send(
             f"user_{recipient.username}",
             {
@@ -194,15 +265,15 @@ class ChatConsumer(AsyncWebsocketConsumer):
         sender_avatar = event['sender_avatar']
         sender_username = event['sender_username']
 
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'call_notification',
             'sender_id': sender_id,
             'sender_avatar': sender_avatar,
             'sender_username': sender_username
-        }))
+        })
 
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(FrameConsumer):
     async def connect(self):
         self.user = self.scope['user']
         if self.user.is_anonymous:
@@ -214,6 +285,8 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
             await self.accept()
+            await presence.user_connected(self.user.id, self.channel_name)
+            self.heartbeat_task = asyncio.get_running_loop().create_task(self.heartbeat())
             logger.info(f"WebSocket connected for user '{self.user.username}'")
 
     async def disconnect(self, close_code):
@@ -221,45 +294,93 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             self.group_name,
             self.channel_name
         )
+        if getattr(self, 'heartbeat_task', None) is not None:
+            self.heartbeat_task.cancel()
+            await presence.user_disconnected(self.user.id, self.channel_name)
         logger.info(f"WebSocket disconnected for user '{self.user.username}' with code {close_code}")
 
-    async def receive(self, text_data):
-        logger.info(f"Received message: {text_data}")
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT_INTERVAL)
+            try:
+                await presence.user_connected(self.user.id, self.channel_name)
+            except Exception as e:
+                logger.error(f"Error refreshing presence: {e}")
+
+    async def receive_frame(self, content):
+        logger.debug("Received message: %s", content)
         try:
-            text_data_json = json.loads(text_data)
-            message_type = text_data_json['type']
+            message_type = content['type']
             if message_type == 'notification':
                 await self.process_notification(self.user)
             elif message_type == 'call_notification':
-                sender = text_data_json['sender']
+                sender = content['sender']
                 await self.send_call_notification(self.user, sender)
         except Exception as e:
             logger.error(f"Error processing message: {e}")
 
     async def process_notification(self, user):
-        logger.info(f"Processing notification for {user}")
+        logger.debug("Processing notification for %s", user)
         try:
-            async for message in MessageModel.objects.filter(receiver=user, is_read=False,
-                                                             notification_send=False).select_related('sender',
-                                                                                                     'receiver'):
-                await self.send_chat_notification(message.sender, message.receiver, message.content)
-                await self.mark_notification_sent(message)
-                logger.info(f"Sending notification: {message}")
+            message_ids, digest = await self.get_notification_digest(user)
+            if message_ids:
+                await self.send_frame({
+                    'type': 'notification_digest',
+                    'senders': digest
+                })
+                await self.mark_notifications_sent(message_ids)
+                logger.debug("Sent notification digest of %s messages to %s", len(message_ids), user)
         except Exception as e:
             logger.error(f"Error processing notification: {e}")
 
-    async def send_chat_notification(self, sender, recipient, notification_message):
-        logger.info(f"Sending notification from {sender.username} to {recipient.username}: {notification_message}")
-        await self.channel_layer.group_send(
-            f"user_{recipient.username}",
-            {
-                'type': 'send_notification',
+    @staticmethod
+    def unnotified_messages(user):
+        """Messages not yet announced to ``user`` in threads where the ``user`` still has unread ones."""
+        threads = ConversationModel.objects.filter(owner=user, unread_count__gt=0).exclude(partner=user)
+        unread = Q()
+        for partner_id, read_watermark in threads.values_list('partner_id', 'read_watermark'):
+            # Each branch names the whole pair so that it can be served by message_pair_timestamp_idx.
+            unread |= Q(sender_id=partner_id, receiver=user, id__gt=read_watermark)
+        if not unread:
+            return MessageModel.objects.none()
+        # Rows marked read before the watermark existed still carry is_read=True.
+        return MessageModel.objects.filter(unread, is_read=False, notification_send=False)
+
+    @timed_db
+    @database_sync_to_async
+    def get_notification_digest(self, user):
+        pending = self.unnotified_messages(user)
+        message_ids = []
+        senders = {}
+        for message_id, sender_id in pending.order_by('timestamp', 'id').values_list('id', 'sender_id'):
+            message_ids.append(message_id)
+            entry = senders.setdefault(sender_id, {'count': 0})
+            entry['count'] += 1
+            entry['latest_id'] = message_id
+        if not message_ids:
+            return [], []
+
+        previews = dict(MessageModel.objects.filter(
+            id__in=[entry['latest_id'] for entry in senders.values()]
+        ).values_list('id', 'content'))
+        digest = []
+        for sender in User.objects.filter(id__in=senders).only('id', 'username', 'avatar'):
+            entry = senders[sender.id]
+            digest.append({
                 'sender_id': sender.id,
-                'sender_username': sender.username,
                 'sender_avatar': sender.avatar.url if sender.avatar else None,
-                'notification': notification_message
-            }
-        )
+                'sender_username': sender.username,
+                'count': entry['count'],
+                'notification': previews[entry['latest_id']],
+                'latest_id': entry['latest_id']
+            })
+        digest.sort(key=lambda entry: entry['latest_id'], reverse=True)
+        return message_ids, digest
+
+    @timed_db
+    @database_sync_to_async
+    def mark_notifications_sent(self, message_ids):
+        MessageModel.objects.filter(id__in=message_ids).update(notification_send=True)
 
     async def send_notification(self, event):
         notification = event['notification']
@@ -267,21 +388,16 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         sender_avatar = event['sender_avatar']
         sender_username = event['sender_username']
 
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'notification',
             'sender_id': sender_id,
             'sender_avatar': sender_avatar,
             'sender_username': sender_username,
             'notification': notification
-        }))
-
-    @database_sync_to_async
-    def mark_notification_sent(self, message):
-        message.notification_send = True
-        message.save()
+        })
 
     async def send_call_notification(self, recipient, sender):
-        logger.info(f"Sending call notification from {sender.username} to {recipient.username}")
+        logger.debug("Sending call notification from %s to %s", sender.username, recipient.username)
         await self.channel_layer.group_send(
             f"user_{recipient.username}",
             {
@@ -297,9 +413,9 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         sender_avatar = event['sender_avatar']
         sender_username = event['sender_username']
 
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'call_notification',
             'sender_id': sender_id,
             'sender_avatar': sender_avatar,
             'sender_username': sender_username
-        }))
+        })
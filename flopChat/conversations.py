@@ -0,0 +1,81 @@
+from django.db import transaction
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+
+def rebuild_conversations(ConversationModel, MessageModel, batch_size=1000):
+    """
+    Rebuild every participant's conversation summary from the message table.
+
+    Takes the models as arguments so that migrations can pass their historical
+    versions. Returns the number of conversations rebuilt and removed.
+    """
+    watermarks = dict(
+        ((owner, partner), watermark)
+        for owner, partner, watermark in ConversationModel.objects.values_list('owner', 'partner', 'read_watermark')
+    )
+    threads = {}
+
+    # Message ids grow with timestamps (auto_now_add), so the highest id is the latest message.
+    pairs = MessageModel.objects.order_by().values('sender', 'receiver').annotate(
+        last_id=Max('id'),
+        read_id=Max('id', filter=Q(is_read=True)),
+    )
+    for pair in pairs.iterator():
+        sender, receiver = pair['sender'], pair['receiver']
+        for owner, partner in ((sender, receiver), (receiver, sender)):
+            thread = threads.setdefault((owner, partner), {
+                'last_id': 0,
+                'watermark': watermarks.get((owner, partner), 0),
+            })
+            thread['last_id'] = max(thread['last_id'], pair['last_id'])
+        # Carry read state over from the is_read flag written before the watermark existed.
+        reader = threads[(receiver, sender)]
+        reader['watermark'] = max(reader['watermark'], pair['read_id'] or 0)
+
+    last_ids = [thread['last_id'] for thread in threads.values()]
+    timestamps = {}
+    for start in range(0, len(last_ids), batch_size):
+        timestamps.update(
+            MessageModel.objects.filter(id__in=last_ids[start:start + batch_size]).values_list('id', 'timestamp')
+        )
+
+    with transaction.atomic():
+        stale = [
+            conversation_id
+            for conversation_id, owner, partner in ConversationModel.objects.values_list('id', 'owner', 'partner')
+            if (owner, partner) not in threads
+        ]
+        for start in range(0, len(stale), batch_size):
+            ConversationModel.objects.filter(id__in=stale[start:start + batch_size]).delete()
+
+        ConversationModel.objects.bulk_create(
+            [
+                ConversationModel(
+                    owner_id=owner,
+                    partner_id=partner,
+                    last_message_id=thread['last_id'],
+                    last_activity=timestamps[thread['last_id']],
+                    read_watermark=thread['watermark'],
+                    unread_count=0,
+                )
+                for (owner, partner), thread in threads.items()
+            ],
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=['owner', 'partner'],
+            update_fields=['last_message', 'last_activity', 'read_watermark', 'unread_count'],
+        )
+
+        watermark = ConversationModel.objects.filter(
+            owner=OuterRef('receiver'), partner=OuterRef('sender')
+        ).values('read_watermark')
+        unread = MessageModel.objects.filter(is_read=False).exclude(sender=F('receiver')).annotate(
+            read_watermark=Coalesce(Subquery(watermark[:1]), 0)
+        ).filter(id__gt=F('read_watermark')).order_by().values('sender', 'receiver').annotate(count=Count('id'))
+        for pair in unread.iterator():
+            ConversationModel.objects.filter(owner=pair['receiver'], partner=pair['sender']).update(
+                unread_count=pair['count']
+            )
+
+    return len(threads), len(stale)
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import time
+
+from channels.layers import BaseChannelLayer, InMemoryChannelLayer
+from django.utils.module_loading import import_string
+
+from flopProject.metrics import GROUP_SEND_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Published to a group when a channel from another process joins it, so cached memberships are refreshed.
+INVALIDATE_TYPE = 'fastpath.invalidate'
+
+
+class LocalFastPathChannelLayer(BaseChannelLayer):
+    """
+    Channel layer wrapper that short-circuits deliveries between consumers in this process.
+
+    Every channel and group membership is still registered with the inner layer
+    (Redis in production), so other processes can reach our consumers as usual.
+    ``group_send`` looks at the group's full membership (cached for
+    ``membership_ttl`` seconds) and, when every member is a channel created by
+    this process, puts the message straight onto the local queues without a
+    round trip to the inner layer. Anything with a remote member goes through
+    the inner layer unchanged.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, inner=None, membership_ttl=5, expiry=60, capacity=100, channel_capacity=None):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        if inner is None:
+            inner = {'BACKEND': 'channels.layers.InMemoryChannelLayer'}
+        if isinstance(inner, dict):
+            inner = import_string(inner['BACKEND'])(**inner.get('CONFIG', {}))
+        self.inner = inner
+        self.membership_ttl = membership_ttl
+        self.local_channels = {}
+        self.local_groups = {}
+        self.memberships = {}
+        self.pending_receives = {}
+
+    async def new_channel(self, prefix='specific.'):
+        channel = await self.inner.new_channel(prefix)
+        self.local_channels[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return channel
+
+    async def send(self, channel, message):
+        queue = self.local_channels.get(channel)
+        if queue is None:
+            await self.inner.send(channel, message)
+            return
+        try:
+            queue.put_nowait(dict(message))
+        except asyncio.QueueFull:
+            raise self.ChannelFull(channel)
+
+    async def receive(self, channel):
+        queue = self.local_channels.get(channel)
+        if queue is None:
+            return await self.inner.receive(channel)
+
+        while True:
+            message = await self.receive_either(channel, queue)
+            if message.get('type') == INVALIDATE_TYPE:
+                self.memberships.pop(message['group'], None)
+                continue
+            return message
+
+    async def receive_either(self, channel, queue):
+        # The inner receive is left running between calls: cancelling it can drop a message
+        # that the inner layer has already handed over.
+        remote = self.pending_receives.get(channel)
+        if remote is None:
+            remote = self.pending_receives[channel] = asyncio.ensure_future(self.inner.receive(channel))
+        local = asyncio.ensure_future(queue.get())
+        try:
+            await asyncio.wait({local, remote}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            local.cancel()
+            remote.cancel()
+            self.forget_channel(channel)
+            raise
+
+        if local.done():
+            return local.result()
+        local.cancel()
+        del self.pending_receives[channel]
+        return remote.result()
+
+    def forget_channel(self, channel):
+        self.local_channels.pop(channel, None)
+        self.pending_receives.pop(channel, None)
+        for group, members in list(self.local_groups.items()):
+            if channel in members:
+                members.discard(channel)
+                self.memberships.pop(group, None)
+
+    async def group_add(self, group, channel):
+        await self.inner.group_add(group, channel)
+        if channel in self.local_channels:
+            self.local_groups.setdefault(group, set()).add(channel)
+        self.memberships.pop(group, None)
+        await self.inner.group_send(group, {'type': INVALIDATE_TYPE, 'group': group})
+
+    async def group_discard(self, group, channel):
+        await self.inner.group_discard(group, channel)
+        members = self.local_groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.local_groups[group]
+        self.memberships.pop(group, None)
+
+    async def group_send(self, group, message):
+        started = time.perf_counter()
+        local_members = self.local_groups.get(group)
+        if local_members:
+            members = await self.group_members(group)
+            if members is not None and members <= local_members:
+                for channel in members:
+                    try:
+                        self.local_channels[channel].put_nowait(dict(message))
+                    except asyncio.QueueFull:
+                        pass
+                GROUP_SEND_SECONDS.observe(time.perf_counter() - started, path='local')
+                return
+        await self.inner.group_send(group, message)
+        GROUP_SEND_SECONDS.observe(time.perf_counter() - started, path='inner')
+
+    async def group_members(self, group):
+        """All channels in ``group`` across every process, or ``None`` if the inner layer can't say."""
+        cached = self.memberships.get(group)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        if isinstance(self.inner, InMemoryChannelLayer):
+            members = frozenset(self.inner.groups.get(group, {}))
+        elif hasattr(self.inner, '_group_key'):
+            connection = self.inner.connection(self.inner.consistent_hash(group))
+            members = frozenset(
+                name.decode('utf8') for name in await connection.zrange(self.inner._group_key(group), 0, -1)
+            )
+        else:
+            return None
+        self.memberships[group] = (time.monotonic() + self.membership_ttl, members)
+        return members
+
+    async def flush(self):
+        self.local_channels.clear()
+        self.local_groups.clear()
+        self.memberships.clear()
+        for task in self.pending_receives.values():
+            task.cancel()
+        self.pending_receives.clear()
+        await self.inner.flush()
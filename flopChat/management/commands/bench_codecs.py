@@ -0,0 +1,81 @@
+import json
+import timeit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from flopChat.protocol import FrameConsumer
+
+AVATAR = 'https://flopbucked.s3.eu-central-1.amazonaws.com/media/avatars/profile_picture_2024.png'
+
+
+def chat_frame(index=0):
+    return {
+        'message': f'Did you see the new legend that dropped today? Message number {index}.',
+        'sender': 'alice',
+        'avatar': AVATAR,
+        'recipient': 'bob',
+        'is_read': False,
+    }
+
+
+def history_frame():
+    return {
+        'type': 'history',
+        'messages': [
+            dict(chat_frame(index), id=10_000 + index, timestamp=f'2024-07-01T20:{index % 60:02d}:00.000000+00:00')
+            for index in range(settings.CHAT_HISTORY_PAGE_SIZE)
+        ],
+        'next_cursor': '2024-07-01T20:00:00.000000+00:00|10000',
+    }
+
+
+def digest_frame():
+    return {
+        'type': 'notification_digest',
+        'senders': [
+            {
+                'sender_id': index,
+                'sender_avatar': AVATAR,
+                'sender_username': f'user_{index}',
+                'count': index * 3 + 1,
+                'notification': chat_frame(index)['message'],
+                'latest_id': 20_000 + index,
+            }
+            for index in range(10)
+        ],
+    }
+
+
+class Command(BaseCommand):
+    help = 'Measure encode/decode cost and payload size of JSON against MessagePack WebSocket frames.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=2000, help='Iterations per measurement.')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        number = options['number']
+        results = []
+        for name, frame in (('chat', chat_frame()), ('history', history_frame()), ('digest', digest_frame())):
+            for codec, binary in (('json', False), ('msgpack', True)):
+                encoded = FrameConsumer.encode_frame(frame, binary=binary)
+                decode_kwargs = {'bytes_data': encoded} if binary else {'text_data': encoded}
+                encode = timeit.timeit(lambda: FrameConsumer.encode_frame(frame, binary=binary), number=number)
+                decode = timeit.timeit(lambda: FrameConsumer.decode_frame(**decode_kwargs), number=number)
+                results.append({
+                    'frame': name,
+                    'codec': codec,
+                    'bytes': len(encoded.encode() if isinstance(encoded, str) else encoded),
+                    'encode_us': encode / number * 1e6,
+                    'decode_us': decode / number * 1e6,
+                })
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+        self.stdout.write(f"{'frame':<8} {'codec':<8} {'bytes':>8} {'encode us':>10} {'decode us':>10}")
+        for row in results:
+            self.stdout.write(
+                f"{row['frame']:<8} {row['codec']:<8} {row['bytes']:>8} {row['encode_us']:>10.2f} {row['decode_us']:>10.2f}"
+            )
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+
+from flopChat import middleware
+from flopChat.middleware import JWTAuthMiddleware
+from flopProject.benchmarks import throwaway_database
+from users.cache import token_cache, user_cache
+from users.models import User
+
+
+async def accept_handshake(scope, receive, send):
+    await send({'type': 'websocket.accept'})
+
+
+class Command(BaseCommand):
+    help = 'Replay a reconnect storm of simultaneous WebSocket handshakes through JWTAuthMiddleware.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--handshakes', type=int, default=3000)
+        parser.add_argument('--users', type=int, default=1000,
+                            help='Distinct users; each one reconnects several sockets at once.')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        with throwaway_database():
+            users = [
+                User.objects.create(username=f'bench_handshake_{index}',
+                                    email=f'bench_handshake_{index}@example.invalid')
+                for index in range(options['users'])
+            ]
+            tokens = [str(AccessToken.for_user(user)) for user in users]
+            storm = [tokens[index % len(tokens)] for index in range(options['handshakes'])]
+            token_cache.clear()
+            user_cache.clear()
+            results = {
+                'handshakes': len(storm),
+                'users': len(users),
+                'cold': asyncio.run(self.replay(storm)),
+                # Same storm again, as after a second network blip.
+                'warm': asyncio.run(self.replay(storm)),
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+        for run in ('cold', 'warm'):
+            row = results[run]
+            self.stdout.write(
+                f"{run:>5}: {row['handshakes_per_second']:10.1f} handshakes/s, {row['db_lookups']:6d} DB lookups, "
+                f"{row['max_concurrent_lookups']:3d} at once"
+            )
+
+    async def replay(self, storm):
+        application = JWTAuthMiddleware(accept_handshake)
+        fetch_user = middleware.fetch_user
+        counts = {'lookups': 0, 'running': 0, 'max_running': 0}
+
+        async def counted_fetch_user(user_id):
+            counts['lookups'] += 1
+            counts['running'] += 1
+            counts['max_running'] = max(counts['max_running'], counts['running'])
+            try:
+                return await fetch_user(user_id)
+            finally:
+                counts['running'] -= 1
+
+        async def handshake(token):
+            scope = {'type': 'websocket', 'query_string': f'token={token}'.encode()}
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            await application(scope, None, send)
+            assert scope['user'].is_authenticated and sent == [{'type': 'websocket.accept'}]
+
+        middleware.fetch_user = counted_fetch_user
+        try:
+            started = time.perf_counter()
+            await asyncio.gather(*(handshake(token) for token in storm))
+            elapsed = time.perf_counter() - started
+        finally:
+            middleware.fetch_user = fetch_user
+        return {
+            'seconds': elapsed,
+            'handshakes_per_second': len(storm) / elapsed,
+            'db_lookups': counts['lookups'],
+            'max_concurrent_lookups': counts['max_running'],
+        }
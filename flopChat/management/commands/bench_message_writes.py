@@ -0,0 +1,74 @@
+import asyncio
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from flopChat.buffer import MessageWriteBuffer
+from flopChat.consumers import ChatConsumer
+from flopChat.models import MessageModel
+from flopProject.benchmarks import throwaway_database
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = 'Compare sustained chat message writes: one INSERT per message against the write-behind buffer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--senders', type=int, default=20, help='Concurrent sending connections.')
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_WRITE_BEHIND_BATCH_SIZE)
+        parser.add_argument('--flush-interval', type=float, default=settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL)
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        with throwaway_database():
+            users = [
+                User.objects.create(username=f'bench_writer_{index}', email=f'bench_writer_{index}@example.invalid')
+                for index in range(options['senders'] + 1)
+            ]
+            results = {
+                'messages': options['messages'],
+                'senders': options['senders'],
+                'per_message': asyncio.run(self.per_message(users, options)),
+                'write_behind': asyncio.run(self.write_behind(users, options)),
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+        for mode in ('per_message', 'write_behind'):
+            self.stdout.write(f"{mode:>13}: {results[mode]:10.1f} messages/s")
+        self.stdout.write(f"{'speedup':>13}: {results['write_behind'] / results['per_message']:10.2f}x")
+
+    async def per_message(self, users, options):
+        consumer = ChatConsumer()
+
+        async def send(sender, count):
+            for index in range(count):
+                await consumer.save_message(sender, users[-1], f'bench {index}')
+
+        return await self.measure(users, options, send)
+
+    async def write_behind(self, users, options):
+        buffer = MessageWriteBuffer(options['batch_size'], options['flush_interval'], settings.CHAT_WRITE_BEHIND_MAX_PENDING)
+
+        async def send(sender, count):
+            for index in range(count):
+                await buffer.add(MessageModel(sender=sender, receiver=users[-1], content=f'bench {index}'))
+
+        rate = await self.measure(users, options, send, buffer.flush)
+        assert buffer.written == options['messages']
+        return rate
+
+    async def measure(self, users, options, send, drain=None):
+        senders = users[:-1]
+        per_sender = options['messages'] // len(senders)
+        counts = [per_sender + (1 if index < options['messages'] % len(senders) else 0) for index in range(len(senders))]
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(sender, count) for sender, count in zip(senders, counts)))
+        if drain is not None:
+            await drain()
+        return options['messages'] / (time.perf_counter() - started)
@@ -0,0 +1,204 @@
+import asyncio
+import json
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from flopProject.benchmarks import throwaway_database
+from users.cache import token_cache, user_cache
+from users.models import User
+
+LAYERS = {
+    'memory': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 10000}},
+    'fastpath': {
+        'BACKEND': 'flopChat.layers.LocalFastPathChannelLayer',
+        'CONFIG': {'capacity': 10000, 'inner': {'BACKEND': 'channels.layers.InMemoryChannelLayer',
+                                                 'CONFIG': {'capacity': 10000}}},
+    },
+}
+# The limiter is exercised by its own tests; here it would only measure its own budgets.
+UNLIMITED = {'default': {'connection': (1e6, 1e6), 'user': (1e6, 1e6)}}
+
+
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000
+
+    return {'count': len(samples), 'p50_ms': at(0.50), 'p95_ms': at(0.95), 'p99_ms': at(0.99),
+            'max_ms': samples[-1] * 1000}
+
+
+class QueryCounter:
+    """Counts statements on every database connection, including the ones opened by sync_to_async threads."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        connection_created.connect(self.install)
+        for connection in connections.all():
+            self.install(connection)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self.install)
+        for connection in connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+class Command(BaseCommand):
+    help = ('Drive simulated users through the chat, notification and call sockets of the ASGI application '
+            'and report throughput, delivery latency and queries per message.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Simulated users, paired into chat rooms.')
+        parser.add_argument('--messages', type=int, default=20, help='Chat messages each user sends.')
+        parser.add_argument('--rate', type=float, default=10, help='Messages per second per user (0 = flat out).')
+        parser.add_argument('--candidates', type=int, default=10, help='ICE candidates each user sends.')
+        parser.add_argument('--layer', choices=sorted(LAYERS), default='memory')
+        parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for deliveries.')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        with throwaway_database():
+            users = [
+                User.objects.create(username=f'bench_rt_{index}', email=f'bench_rt_{index}@example.invalid')
+                for index in range(options['users'] - options['users'] % 2)
+            ]
+            token_cache.clear()
+            user_cache.clear()
+            with override_settings(CHANNEL_LAYERS={'default': LAYERS[options['layer']]}, WS_RATE_LIMITS=UNLIMITED):
+                results = asyncio.run(self.run(users, options))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+        self.stdout.write(
+            f"{results['users']} users, {results['chat_messages']} chat messages in {results['seconds']:.2f}s: "
+            f"{results['messages_per_second']:.1f} messages/s, {results['queries_per_message']:.2f} queries/message"
+        )
+        for path in ('chat', 'notification', 'call'):
+            row = results[path]
+            if row['count']:
+                self.stdout.write(
+                    f"{path:>12}: {row['count']:6d} delivered  p50 {row['p50_ms']:7.2f}ms  "
+                    f"p95 {row['p95_ms']:7.2f}ms  p99 {row['p99_ms']:7.2f}ms  max {row['max_ms']:7.2f}ms"
+                )
+
+    async def run(self, users, options):
+        # Count from before the sockets open: the test database keeps its connections open, so the
+        # worker threads that serve the handshakes never open another one for the counter to hook.
+        with QueryCounter() as queries:
+            return await self.measure(users, options, queries)
+
+    async def measure(self, users, options, queries):
+        from flopProject.asgi import application
+
+        sent = {}
+        latencies = {'chat': [], 'notification': [], 'call': []}
+        expected = {
+            'chat': len(users) * options['messages'],
+            'notification': len(users) * options['messages'],
+            'call': len(users) * options['candidates'],
+        }
+        done = asyncio.Event()
+
+        def record(path, key):
+            started = sent.get((path, key))
+            if started is not None:
+                latencies[path].append(time.perf_counter() - started)
+                if all(len(latencies[name]) >= count for name, count in expected.items()):
+                    done.set()
+
+        async def open_socket(path, token):
+            communicator = WebsocketCommunicator(application, f'{path}?token={token}')
+            connected, _ = await communicator.connect(timeout=options['timeout'])
+            assert connected, path
+            return communicator
+
+        async def read(communicator, handle):
+            while True:
+                handle(await communicator.receive_json_from(timeout=options['timeout']))
+
+        sockets = []
+        for index, user in enumerate(users):
+            token = str(AccessToken.for_user(user))
+            partner = users[index ^ 1]
+            room = f'bench_{index // 2}'
+            chat = await open_socket(f'/ws/chat/{room}/', token)
+            notifications = await open_socket('/ws/notification/', token)
+            call = await open_socket(f'/ws/call/{room}/', token)
+            sockets.append((user, partner, chat, notifications, call))
+
+        readers = []
+        for user, partner, chat, notifications, call in sockets:
+            # Rooms echo to the sender as well; only the partner's copy counts as a delivery.
+            readers.append(asyncio.ensure_future(read(chat, lambda frame, me=user.username: (
+                frame.get('recipient') == me and record('chat', frame['message'])))))
+            readers.append(asyncio.ensure_future(read(notifications, lambda frame: (
+                frame.get('type') == 'notification' and record('notification', frame['notification'])))))
+            readers.append(asyncio.ensure_future(read(call, lambda frame: (
+                frame.get('type') == 'ice_candidates' and [record('call', candidate) for candidate in frame['candidates']]
+            ))))
+
+        async def drive(user, partner, chat, call):
+            interval = 1 / options['rate'] if options['rate'] else 0
+            for index in range(max(options['messages'], options['candidates'])):
+                if index < options['messages']:
+                    text = f'{user.username}:{index}'
+                    sent[('chat', text)] = sent[('notification', text)] = time.perf_counter()
+                    await chat.send_json_to({'type': 'chat_message', 'sender': user.username,
+                                             'recipient': partner.username, 'message': text})
+                if index < options['candidates']:
+                    candidate = f'{user.username}:candidate:{index}'
+                    sent[('call', candidate)] = time.perf_counter()
+                    await call.send_json_to({'type': 'ice_candidate', 'candidate': candidate})
+                await asyncio.sleep(interval)
+
+        setup_queries = queries.count
+        started = time.perf_counter()
+        await asyncio.gather(*(drive(user, partner, chat, call) for user, partner, chat, _, call in sockets))
+        try:
+            await asyncio.wait_for(done.wait(), options['timeout'])
+        except asyncio.TimeoutError:
+            self.stderr.write('Timed out waiting for deliveries; reporting what arrived.')
+        elapsed = time.perf_counter() - started
+        query_count = queries.count - setup_queries
+
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        for _, _, chat, notifications, call in sockets:
+            for communicator in (chat, notifications, call):
+                await communicator.disconnect()
+
+        chat_messages = len(users) * options['messages']
+        return {
+            'users': len(users),
+            'layer': options['layer'],
+            'chat_messages': chat_messages,
+            'seconds': elapsed,
+            'messages_per_second': chat_messages / elapsed,
+            'queries_per_message': query_count / chat_messages if chat_messages else 0,
+            'chat': percentiles(latencies['chat']),
+            'notification': percentiles(latencies['notification']),
+            'call': percentiles(latencies['call']),
+        }
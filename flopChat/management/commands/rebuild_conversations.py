@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from flopChat.conversations import rebuild_conversations
+from flopChat.models import ConversationModel, MessageModel
+
+
+class Command(BaseCommand):
+    help = 'Backfill and repair the per-participant conversation summaries from the message table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        rebuilt, removed = rebuild_conversations(ConversationModel, MessageModel, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {rebuilt} conversations, removed {removed} stale ones."
+        ))
@@ -1,3 +1,6 @@
+import asyncio
+import time
+
 from channels.middleware import BaseMiddleware
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
@@ -7,16 +10,68 @@ import jwt
 from django.conf import settings
 from urllib.parse import parse_qs
 import logging
+from flopProject.metrics import timed_db
+from users.cache import token_cache, user_cache
+
+# Per event loop: the semaphore capping handshake DB lookups and the lookups in flight by user id.
+_lookups = {}
+
+
+async def get_user(user_id):
+    user = user_cache.get_by_id(user_id)
+    if user is None:
+        user = await load_user(user_id)
+        if not user.is_anonymous:
+            user_cache.set(user)
+    return user
+
+
+async def load_user(user_id):
+    """Fetch a user for a handshake, sharing one query between concurrent handshakes for the same user."""
+    loop = asyncio.get_running_loop()
+    if loop not in _lookups:
+        _lookups.clear()
+        _lookups[loop] = (asyncio.Semaphore(settings.WS_HANDSHAKE_DB_CONCURRENCY), {})
+    semaphore, in_flight = _lookups[loop]
 
+    lookup = in_flight.get(user_id)
+    if lookup is None:
+        async def fetch():
+            async with semaphore:
+                return await fetch_user(user_id)
+
+        lookup = in_flight[user_id] = asyncio.ensure_future(fetch())
+        lookup.add_done_callback(lambda _: in_flight.pop(user_id, None))
+    # Shielded so that one handshake giving up does not cancel the lookup for the others.
+    return await asyncio.shield(lookup)
+
+
+@timed_db
 @database_sync_to_async
-def get_user(user_id):
+def fetch_user(user_id):
     User = get_user_model()
     try:
+        # Full rows: the user ends up in scope['user'] and user_cache, where async code can't load deferred fields.
         return User.objects.get(id=user_id)
     except User.DoesNotExist:
         return AnonymousUser()
 
 
+async def authenticate(token):
+    cached = token_cache.get(token)
+    if cached is not None:
+        claims, user, loaded_at = cached
+        if time.monotonic() - loaded_at < settings.USER_CACHE_TTL:
+            return user
+    else:
+        claims = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+
+    user = await get_user(claims['user_id'])
+    if user.is_anonymous or not user.is_active:
+        token_cache.discard(token)
+        return AnonymousUser()
+    token_cache.set(token, claims, user)
+    return user
 
 
 logger = logging.getLogger(__name__)
@@ -27,9 +82,8 @@ class JWTAuthMiddleware(BaseMiddleware):
         if 'token' in query_params:
             token_key = query_params['token'][0]
             try:
-                decoded_data = jwt.decode(token_key, settings.SECRET_KEY, algorithms=["HS256"])
-                scope['user'] = await get_user(decoded_data['user_id'])
-            except (InvalidToken, TokenError, jwt.DecodeError, KeyError) as e:
+                scope['user'] = await authenticate(token_key)
+            except (InvalidToken, TokenError, jwt.InvalidTokenError, KeyError) as e:
                 logger.error(f"Token error: {e}")
                 scope['user'] = AnonymousUser()
         else:
@@ -39,4 +93,4 @@ class JWTAuthMiddleware(BaseMiddleware):
             return await super().__call__(scope, receive, send)
         except Exception as e:
             logger.error(f"WebSocket error: {e}")
-            raise e
\ No newline at end of file
+            raise e
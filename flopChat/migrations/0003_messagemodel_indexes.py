@@ -0,0 +1,27 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:53
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flopChat', '0002_messagemodel_notification_send'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='messagemodel',
+            index=models.Index(fields=['sender', 'receiver', 'timestamp'], name='message_pair_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagemodel',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['receiver', 'sender'], name='message_unread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagemodel',
+            index=models.Index(condition=models.Q(('is_read', False), ('notification_send', False)), fields=['receiver'], name='message_unnotified_idx'),
+        ),
+    ]
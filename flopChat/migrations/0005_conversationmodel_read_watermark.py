@@ -0,0 +1,33 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flopChat', '0004_conversationmodel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationmodel',
+            name='read_watermark',
+            field=models.BigIntegerField(default=0),
+        ),
+        # Nothing sets is_read any more, so an index conditioned on it would cover every new message.
+        migrations.RemoveIndex(
+            model_name='messagemodel',
+            name='message_unread_idx',
+        ),
+        # Only messages for offline recipients are stored un-notified, and the digest flips them, so
+        # the unnotified index stays small once the is_read part is gone.
+        migrations.RemoveIndex(
+            model_name='messagemodel',
+            name='message_unnotified_idx',
+        ),
+        migrations.AddIndex(
+            model_name='messagemodel',
+            index=models.Index(condition=models.Q(('notification_send', False)), fields=['receiver'], name='message_unnotified_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations
+
+from flopChat.conversations import rebuild_conversations
+
+
+def backfill(apps, schema_editor):
+    rebuild_conversations(apps.get_model('flopChat', 'ConversationModel'), apps.get_model('flopChat', 'MessageModel'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flopChat', '0005_conversationmodel_read_watermark'),
+    ]
+
+    # The partner list, the offline digest and mark_read all start from the conversation table,
+    # so existing messages must be summarized before the new code serves them.
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Coalesce, Greatest
 
 from users.models import User
 
@@ -9,4 +10,128 @@ class MessageModel(models.Model):
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
-    notification_send = models.BooleanField(default=False)
\ No newline at end of file
+    notification_send = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sender', 'receiver', 'timestamp'], name='message_pair_timestamp_idx'),
+            # Messages stored for an offline recipient, until the notification digest announces them.
+            models.Index(fields=['receiver'], condition=models.Q(notification_send=False),
+                         name='message_unnotified_idx'),
+        ]
+
+
+class ConversationModel(models.Model):
+    owner = models.ForeignKey(User, related_name='conversations', on_delete=models.CASCADE)
+    partner = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    last_message = models.ForeignKey(MessageModel, related_name='+', null=True, blank=True, on_delete=models.SET_NULL)
+    last_activity = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+    # Messages from ``partner`` with an id up to this one have been read by ``owner``.
+    read_watermark = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'partner'], name='conversation_owner_partner_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['owner', '-last_activity'], name='conversation_recent_idx'),
+        ]
+
+    @classmethod
+    def mark_read(cls, owner, partner):
+        """
+        Move ``owner``'s read watermark to the newest message in the thread; return whether anything was unread.
+
+        One UPDATE when the thread has a row. A thread without one yet (say, its first
+        messages are still in the write-behind buffer) gets a row created from the messages.
+        """
+        threads = cls.objects.filter(owner=owner, partner=partner)
+        if threads.filter(unread_count__gt=0).update(
+            read_watermark=Greatest(models.F('read_watermark'), Coalesce(models.F('last_message'), 0)),
+            unread_count=0,
+        ):
+            return True
+        if threads.exists():
+            return False
+
+        messages = MessageModel.objects.filter(
+            models.Q(sender=owner, receiver=partner) | models.Q(sender=partner, receiver=owner)
+        )
+        # Message ids grow with timestamps (auto_now_add), so the highest id is the latest message.
+        latest = messages.order_by('-id').first()
+        if latest is None:
+            return False
+        _, created = cls.objects.get_or_create(owner=owner, partner=partner, defaults={
+            'last_message': latest,
+            'last_activity': latest.timestamp,
+            'read_watermark': latest.id,
+        })
+        if not created:
+            # A concurrent send or mark_read created the row first.
+            return cls.mark_read(owner, partner)
+        return owner != partner and messages.filter(sender=partner).exists()
+
+    @classmethod
+    def record_message(cls, message):
+        """Point both participants' threads at ``message``; call inside the transaction that created it."""
+        cls.record_messages([message])
+
+    @classmethod
+    def record_messages(cls, messages):
+        """Advance every thread touched by ``messages`` with one UPDATE per pair of participants."""
+        pairs = {}
+        for message in messages:
+            pair = pairs.setdefault(frozenset((message.sender_id, message.receiver_id)),
+                                    {'latest': message, 'unread': {}})
+            if (message.timestamp, message.id) > (pair['latest'].timestamp, pair['latest'].id):
+                pair['latest'] = message
+            if message.sender_id != message.receiver_id:
+                pair['unread'][message.receiver_id] = pair['unread'].get(message.receiver_id, 0) + 1
+        for pair in pairs.values():
+            cls._advance(pair['latest'], pair['unread'])
+
+    @classmethod
+    def _advance(cls, message, unread):
+        sender_id, receiver_id = message.sender_id, message.receiver_id
+        owners = {sender_id, receiver_id}
+        threads = cls.objects.filter(
+            models.Q(owner_id=sender_id, partner_id=receiver_id) | models.Q(owner_id=receiver_id, partner_id=sender_id)
+        )
+        updated = cls._move_threads(threads, message, unread)
+        if updated == len(owners):
+            return
+
+        # First message between the two users. Threads are created in pairs, so normally neither existed.
+        missing = owners if not updated else owners - set(threads.values_list('owner_id', flat=True))
+        for owner_id in missing:
+            partner_id = receiver_id if owner_id == sender_id else sender_id
+            _, created = cls.objects.get_or_create(
+                owner_id=owner_id,
+                partner_id=partner_id,
+                defaults={
+                    'last_message': message,
+                    'last_activity': message.timestamp,
+                    'unread_count': unread.get(owner_id, 0),
+                }
+            )
+            if not created:
+                # A concurrent first message created the thread after the UPDATE above missed it.
+                cls._move_threads(cls.objects.filter(owner_id=owner_id, partner_id=partner_id), message, unread)
+
+    @classmethod
+    def _move_threads(cls, threads, message, unread):
+        increment = models.Case(
+            *[models.When(owner_id=owner_id, then=models.Value(count)) for owner_id, count in unread.items()],
+            default=models.Value(0)
+        ) if unread else models.Value(0)
+
+        # A concurrent send may already have moved a thread past this message, so only move forward.
+        is_newer = models.Q(last_activity__isnull=True) | models.Q(last_activity__lte=message.timestamp)
+        return threads.update(
+            last_message=models.Case(models.When(is_newer, then=models.Value(message.id)),
+                                     default=models.F('last_message'), output_field=models.BigIntegerField()),
+            last_activity=models.Case(models.When(is_newer, then=models.Value(message.timestamp)),
+                                      default=models.F('last_activity'), output_field=models.DateTimeField()),
+            unread_count=models.F('unread_count') + increment,
+        )
@@ -0,0 +1,25 @@
+from django.conf import settings
+
+from .store import get_store
+
+
+def presence_key(user_id):
+    return f'presence:{user_id}'
+
+
+async def user_connected(user_id, channel_name):
+    """Count ``channel_name`` as one of the user's open notification sockets; also serves as the heartbeat."""
+    await get_store().touch(presence_key(user_id), channel_name, settings.PRESENCE_TTL)
+
+
+async def user_disconnected(user_id, channel_name):
+    await get_store().discard(presence_key(user_id), channel_name)
+
+
+async def is_online(user_id):
+    return await get_store().count(presence_key(user_id)) > 0
+
+
+async def online_status(user_ids):
+    counts = await get_store().count_many([presence_key(user_id) for user_id in user_ids])
+    return {user_id: count > 0 for user_id, count in zip(user_ids, counts)}
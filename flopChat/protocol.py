@@ -0,0 +1,208 @@
+import asyncio
+import json
+import logging
+from urllib.parse import parse_qs
+
+import msgpack
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+
+from flopProject.metrics import (
+    WS_COALESCE_BYTES_SAVED, WS_COALESCED_FRAMES, WS_COALESCED_MESSAGES, WS_CONNECTIONS, WS_RECEIVE_SECONDS,
+    WS_SLOW_CONSUMER_CLOSES,
+)
+from .ratelimit import RateLimiter
+from .store import get_store
+
+logger = logging.getLogger(__name__)
+
+MSGPACK_SUBPROTOCOL = 'flop.msgpack.v1'
+
+# Close code sent to coalescing clients that fall too far behind.
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# Close code for clients that keep sending after being told to slow down.
+RATE_LIMITED_CLOSE_CODE = 4029
+
+
+def frame_overhead(length):
+    """Size of the header on an unmasked server-to-client WebSocket frame carrying ``length`` bytes."""
+    if length < 126:
+        return 2
+    if length < 65536:
+        return 4
+    return 10
+
+
+def array_overhead(count, binary):
+    """Bytes spent wrapping ``count`` messages in one JSON or MessagePack array."""
+    if binary:
+        return 1 if count < 16 else 3 if count < 65536 else 5
+    return 2 + len(', ') * (count - 1)
+
+
+class FrameConsumer(AsyncWebsocketConsumer):
+    """
+    WebSocket consumer that negotiates the frame encoding with the client.
+
+    JSON text frames stay the default. Clients that offer the
+    ``flop.msgpack.v1`` subprotocol get MessagePack binary frames carrying
+    the same message schema. Subclasses implement ``receive_frame`` and
+    reply with ``send_frame``.
+
+    Clients that connect with ``?coalesce`` (optionally ``?coalesce=<ms>``)
+    receive every outbound frame as an array of messages: frames produced
+    within the coalescing window are sent together, in order. A client whose
+    queue grows past ``WS_COALESCE_MAX_QUEUE`` is disconnected with code 4008
+    and is expected to reconnect and page history back in.
+
+    Inbound frames are rate limited per message ``type`` (see ``RateLimiter``).
+    Frames over budget are dropped and answered with a ``slow_down`` frame
+    carrying ``retry_after`` in seconds; repeat offenders are closed with 4029.
+    """
+
+    subprotocol = None
+    coalesce_window = None
+    rate_limiter = None
+    accepted = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None and MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', ()):
+            subprotocol = MSGPACK_SUBPROTOCOL
+        self.subprotocol = subprotocol
+        self.coalesce_window = self.requested_coalesce_window()
+        if self.coalesce_window is not None:
+            self.outbox = []
+            self.flush_task = None
+            self.coalesce_stats = {'messages': 0, 'frames': 0, 'bytes_saved': 0}
+        await super().accept(subprotocol, headers)
+        self.accepted = True
+        WS_CONNECTIONS.inc(consumer=type(self).__name__)
+
+    def requested_coalesce_window(self):
+        query_params = parse_qs(self.scope.get('query_string', b'').decode(), keep_blank_values=True)
+        if 'coalesce' not in query_params:
+            return None
+        try:
+            window = float(query_params['coalesce'][0]) / 1000
+        except ValueError:
+            window = settings.WS_COALESCE_WINDOW
+        if window <= 0:
+            return None
+        return min(window, settings.WS_COALESCE_MAX_WINDOW)
+
+    async def websocket_disconnect(self, message):
+        if self.accepted:
+            self.accepted = False
+            WS_CONNECTIONS.dec(consumer=type(self).__name__)
+        if self.coalesce_window is not None:
+            if self.flush_task is not None:
+                self.flush_task.cancel()
+            stats = self.coalesce_stats
+            logger.info(f"Coalesced {stats['messages']} messages into {stats['frames']} frames, "
+                        f"saving {stats['bytes_saved']} bytes")
+        await super().websocket_disconnect(message)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            content = self.decode_frame(text_data, bytes_data)
+        except ValueError as e:
+            logger.error(f"Error decoding frame: {e}")
+            return
+        if not await self.within_rate_limit(content):
+            return
+        message_type = content.get('type') if isinstance(content, dict) else None
+        if not isinstance(message_type, str) or message_type not in settings.WS_RATE_LIMITS:
+            # Known frame types only, so that clients can't create label values at will.
+            message_type = 'other'
+        with WS_RECEIVE_SECONDS.time(consumer=type(self).__name__, type=message_type):
+            await self.receive_frame(content)
+
+    async def within_rate_limit(self, content):
+        if self.rate_limiter is None:
+            user = self.scope.get('user')
+            user_id = user.id if user is not None and user.is_authenticated else None
+            self.rate_limiter = RateLimiter(get_store(self.channel_layer), user_id)
+
+        message_type = content.get('type') if isinstance(content, dict) else None
+        retry_after = await self.rate_limiter.check(message_type)
+        if not retry_after:
+            return True
+        if self.rate_limiter.abusive:
+            logger.warning(f"Closing WebSocket client that kept exceeding the '{message_type}' rate limit")
+            await self.close(code=RATE_LIMITED_CLOSE_CODE)
+        else:
+            await self.send_frame({'type': 'slow_down', 'for': message_type, 'retry_after': round(retry_after, 3)})
+        return False
+
+    async def receive_frame(self, content):
+        pass
+
+    async def send_frame(self, content, close=False):
+        if self.coalesce_window is None:
+            await self.write_frame(content, close)
+            return
+
+        if self.outbox is None:
+            return
+        self.outbox.append(content)
+        if close:
+            await self.flush_outbox(close=True)
+        elif len(self.outbox) > settings.WS_COALESCE_MAX_QUEUE:
+            logger.warning(f"Dropping slow WebSocket client with {len(self.outbox)} queued messages")
+            WS_SLOW_CONSUMER_CLOSES.inc(consumer=type(self).__name__)
+            self.outbox = None
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+        elif self.flush_task is None:
+            self.flush_task = asyncio.get_running_loop().create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.coalesce_window)
+        self.flush_task = None
+        await self.flush_outbox()
+
+    async def flush_outbox(self, close=False):
+        if self.flush_task is not None and self.flush_task is not asyncio.current_task():
+            self.flush_task.cancel()
+            self.flush_task = None
+        messages, self.outbox = self.outbox, ([] if self.outbox is not None else None)
+        if not messages:
+            return
+
+        payload = await self.write_frame(messages, close)
+        # Estimate against sending each message alone: one header each and no array wrapping.
+        average_length = len(payload) // len(messages)
+        bytes_saved = (len(messages) * frame_overhead(average_length)
+                       - frame_overhead(len(payload)) - array_overhead(len(messages), self.binary))
+        stats = self.coalesce_stats
+        stats['messages'] += len(messages)
+        stats['frames'] += 1
+        stats['bytes_saved'] += bytes_saved
+        consumer = type(self).__name__
+        WS_COALESCED_MESSAGES.inc(len(messages), consumer=consumer)
+        WS_COALESCED_FRAMES.inc(consumer=consumer)
+        WS_COALESCE_BYTES_SAVED.inc(bytes_saved, consumer=consumer)
+
+    async def write_frame(self, content, close=False):
+        payload = self.encode_frame(content, self.binary)
+        if self.binary:
+            await self.send(bytes_data=payload, close=close)
+        else:
+            await self.send(text_data=payload, close=close)
+        return payload
+
+    @property
+    def binary(self):
+        return self.subprotocol == MSGPACK_SUBPROTOCOL
+
+    @classmethod
+    def decode_frame(cls, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            return msgpack.unpackb(bytes_data)
+        return json.loads(text_data)
+
+    @classmethod
+    def encode_frame(cls, content, binary=False):
+        if binary:
+            return msgpack.packb(content)
+        return json.dumps(content)
@@ -0,0 +1,73 @@
+import logging
+import time
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Holds up to ``burst`` tokens and refills at ``rate`` tokens per second."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, cost=1):
+        """Spend ``cost`` tokens; returns 0 on success or the seconds to wait until they are available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Inbound frame budget for one WebSocket connection.
+
+    Each message type has a bucket for the connection, kept in memory, and one
+    for the user, kept in the shared store so that it covers every socket the
+    user has open on any worker. ``check`` returns the number of seconds to
+    back off, or 0 if the frame may be handled. Every refusal is a strike;
+    ``abusive`` turns true once ``WS_RATE_LIMIT_MAX_STRIKES`` happen within
+    ``WS_RATE_LIMIT_STRIKE_WINDOW`` seconds.
+    """
+
+    def __init__(self, store, user_id=None):
+        self.store = store
+        self.user_id = user_id
+        self.buckets = {}
+        self.strikes = deque()
+
+    async def check(self, message_type):
+        if not isinstance(message_type, str) or message_type not in settings.WS_RATE_LIMITS:
+            message_type = 'default'
+        limits = settings.WS_RATE_LIMITS[message_type]
+
+        bucket = self.buckets.get(message_type)
+        if bucket is None:
+            bucket = self.buckets[message_type] = TokenBucket(*limits['connection'])
+        retry_after = bucket.take()
+        if not retry_after and self.user_id is not None:
+            try:
+                retry_after = await self.store.take(f'ratelimit:{self.user_id}:{message_type}', *limits['user'])
+            except Exception as e:
+                # Fail open: the per-connection bucket still applies.
+                logger.error(f"Error checking user rate limit: {e}")
+
+        if retry_after:
+            now = time.monotonic()
+            self.strikes.append(now)
+            while self.strikes[0] < now - settings.WS_RATE_LIMIT_STRIKE_WINDOW:
+                self.strikes.popleft()
+        return retry_after
+
+    @property
+    def abusive(self):
+        return len(self.strikes) >= settings.WS_RATE_LIMIT_MAX_STRIKES
@@ -0,0 +1,15 @@
+from rest_framework import serializers
+
+from .models import ConversationModel
+
+
+class ConversationSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source='partner.id', read_only=True)
+    username = serializers.CharField(source='partner.username', read_only=True)
+    avatar = serializers.ImageField(source='partner.avatar', read_only=True)
+    last_message = serializers.CharField(source='last_message.content', default=None, read_only=True)
+    last_message_timestamp = serializers.DateTimeField(source='last_activity', read_only=True)
+
+    class Meta:
+        model = ConversationModel
+        fields = ('id', 'username', 'avatar', 'last_message', 'last_message_timestamp', 'unread_count')
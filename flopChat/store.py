@@ -0,0 +1,180 @@
+import time
+import weakref
+
+from channels.layers import get_channel_layer
+
+from .ratelimit import TokenBucket
+
+# Token bucket refill and spend in one step, timed by the Redis clock so that workers agree.
+TAKE_SCRIPT = """
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(retry_after)
+"""
+
+
+class InMemoryStore:
+    """
+    Process-local stand-in for ``RedisStore``, used with the in-memory channel layer.
+
+    Keys hold sets of members, each with its own expiry time, hashes, or token buckets.
+    """
+
+    def __init__(self):
+        self.sets = {}
+        self.hashes = {}
+        self.buckets = {}
+
+    async def touch(self, key, member, ttl):
+        self.sets.setdefault(key, {})[member] = time.time() + ttl
+
+    async def discard(self, key, member):
+        members = self.sets.get(key)
+        if members is not None:
+            members.pop(member, None)
+            if not members:
+                del self.sets[key]
+
+    async def count(self, key):
+        now = time.time()
+        return sum(1 for expires in self.sets.get(key, {}).values() if expires > now)
+
+    async def count_many(self, keys):
+        return [await self.count(key) for key in keys]
+
+    async def hash_set(self, key, field, value, ttl):
+        expires, fields = self.hashes.get(key, (0, {}))
+        if expires <= time.time():
+            fields = {}
+        fields[field] = value
+        self.hashes[key] = (time.time() + ttl, fields)
+
+    async def hash_delete(self, key, field):
+        """Remove ``field`` and return how many fields are left."""
+        fields = await self.hash_get_all(key)
+        fields.pop(field, None)
+        if not fields:
+            self.hashes.pop(key, None)
+        return len(fields)
+
+    async def hash_get_all(self, key):
+        expires, fields = self.hashes.get(key, (0, {}))
+        if expires <= time.time():
+            self.hashes.pop(key, None)
+            return {}
+        return fields
+
+    async def take(self, key, rate, burst, cost=1):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        return bucket.take(cost)
+
+
+class RedisStore:
+    """
+    Shared state for the consumers, kept next to the channel layer in the same Redis.
+
+    Expiring sets are sorted sets scored by expiry time, so entries left behind by a
+    worker that died without cleaning up drop out on their own.
+    """
+
+    def __init__(self, layer, prefix='flop:'):
+        self.layer = layer
+        self.prefix = prefix
+        self.scripts = {}
+
+    def connection(self, key):
+        return self.layer.connection(self.layer.consistent_hash(key))
+
+    async def touch(self, key, member, ttl):
+        key = self.prefix + key
+        now = time.time()
+        async with self.connection(key).pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zadd(key, {member: now + ttl})
+            pipe.expire(key, int(ttl) + 1)
+            await pipe.execute()
+
+    async def discard(self, key, member):
+        key = self.prefix + key
+        await self.connection(key).zrem(key, member)
+
+    async def count(self, key):
+        key = self.prefix + key
+        return await self.connection(key).zcount(key, f'({time.time()}', '+inf')
+
+    async def count_many(self, keys):
+        now = time.time()
+        by_connection = {}
+        for position, key in enumerate(keys):
+            key = self.prefix + key
+            by_connection.setdefault(self.layer.consistent_hash(key), []).append((position, key))
+
+        counts = [0] * len(keys)
+        for index, entries in by_connection.items():
+            async with self.layer.connection(index).pipeline(transaction=False) as pipe:
+                for _, key in entries:
+                    pipe.zcount(key, f'({now}', '+inf')
+                results = await pipe.execute()
+            for (position, _), result in zip(entries, results):
+                counts[position] = result
+        return counts
+
+    async def hash_set(self, key, field, value, ttl):
+        key = self.prefix + key
+        async with self.connection(key).pipeline(transaction=False) as pipe:
+            pipe.hset(key, field, value)
+            pipe.expire(key, int(ttl))
+            await pipe.execute()
+
+    async def hash_delete(self, key, field):
+        """Remove ``field`` and return how many fields are left."""
+        key = self.prefix + key
+        async with self.connection(key).pipeline(transaction=True) as pipe:
+            pipe.hdel(key, field)
+            pipe.hlen(key)
+            _, remaining = await pipe.execute()
+        return remaining
+
+    async def hash_get_all(self, key):
+        key = self.prefix + key
+        fields = await self.connection(key).hgetall(key)
+        return {field.decode(): value.decode() for field, value in fields.items()}
+
+    async def take(self, key, rate, burst, cost=1):
+        """Spend ``cost`` tokens from a shared bucket; returns 0 or the seconds to wait."""
+        key = self.prefix + key
+        index = self.layer.consistent_hash(key)
+        script = self.scripts.get(index)
+        if script is None:
+            script = self.scripts[index] = self.layer.connection(index).register_script(TAKE_SCRIPT)
+        return float(await script(keys=[key], args=[rate, burst, cost]))
+
+
+_stores = weakref.WeakKeyDictionary()
+
+
+def get_store(layer=None):
+    """The store that lives alongside ``layer`` (the default channel layer if omitted)."""
+    if layer is None:
+        layer = get_channel_layer()
+    store = _stores.get(layer)
+    if store is None:
+        backend = getattr(layer, 'inner', layer)
+        store = RedisStore(backend) if hasattr(backend, 'consistent_hash') else InMemoryStore()
+        _stores[layer] = store
+    return store
@@ -1,3 +1,884 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import jwt
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Q
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from flopChat import consumers, middleware, presence
+from flopChat.buffer import MessageWriteBuffer
+from flopChat.consumers import ChatConsumer, NotificationConsumer
+from flopChat.layers import LocalFastPathChannelLayer
+from flopChat.protocol import (
+    MSGPACK_SUBPROTOCOL, RATE_LIMITED_CLOSE_CODE, SLOW_CONSUMER_CLOSE_CODE, FrameConsumer,
+)
+from flopChat.ratelimit import RateLimiter
+from flopChat.store import InMemoryStore, get_store
+from flopChat.voice_consumer import VoiceChatConsumer, peers_key
+from flopChat.models import ConversationModel, MessageModel
+from flopProject.metrics import WS_COALESCED_FRAMES, WS_COALESCED_MESSAGES, WS_SLOW_CONSUMER_CLOSES
+from users.cache import token_cache, user_cache
+from users.models import User
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+async def connect(consumer, path, user, **url_kwargs):
+    communicator = WebsocketCommunicator(consumer.as_asgi(), path)
+    communicator.scope['url_route'] = {'kwargs': url_kwargs}
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+class MessageQueryPlanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', email='alice@example.com')
+        cls.bob = User.objects.create(username='bob', email='bob@example.com')
+        MessageModel.objects.create(sender=cls.alice, receiver=cls.bob, content='hi')
+        MessageModel.objects.create(sender=cls.bob, receiver=cls.alice, content='hey')
+
+    def assertUsesIndex(self, queryset, *index_names):
+        if connection.vendor == 'postgresql':
+            # The test tables are tiny, so make the planner prove an index path exists.
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        elif connection.vendor != 'sqlite':
+            self.skipTest(f"No plan assertions for {connection.vendor}")
+
+        plan = queryset.explain()
+        self.assertNotIn('Seq Scan', plan)
+        self.assertNotIn('SCAN flopChat_messagemodel', plan)
+        self.assertTrue(any(name in plan for name in index_names), plan)
+
+    def test_history_uses_pair_index(self):
+        queryset = MessageModel.objects.filter(
+            Q(sender=self.alice, receiver=self.bob) | Q(sender=self.bob, receiver=self.alice)
+        ).order_by('-timestamp', '-id')[:51]
+        self.assertUsesIndex(queryset, 'message_pair_timestamp_idx')
+
+    def test_last_message_uses_pair_index(self):
+        queryset = MessageModel.objects.filter(sender=self.alice, receiver=self.bob).order_by('-timestamp')[:1]
+        self.assertUsesIndex(queryset, 'message_pair_timestamp_idx')
+
+    def test_notification_digest_does_not_scan_messages(self):
+        carol = User.objects.create(username='carol', email='carol@example.com')
+        for sender in (self.bob, carol):
+            ConversationModel.record_message(MessageModel.objects.create(sender=sender, receiver=self.alice,
+                                                                         content='ping'))
+        queryset = NotificationConsumer.unnotified_messages(self.alice)
+        # Which index wins depends on the planner's statistics (SQLite seeks the sender index by id
+        # on tables this small); what matters is that every branch is an index search.
+        self.assertUsesIndex(queryset, 'message_pair_timestamp_idx', 'flopChat_messagemodel_sender_id',
+                             'message_unnotified_idx')
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ChatSendPathTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', email='alice@example.com')
+        cls.bob = User.objects.create(username='bob', email='bob@example.com')
+        message = MessageModel.objects.create(sender=cls.bob, receiver=cls.alice, content='hey')
+        ConversationModel.record_message(message)
+
+    def setUp(self):
+        user_cache.clear()
+        user_cache.set(self.alice)
+        user_cache.set(self.bob)
+
+    async def exchange(self, text):
+        chat = await connect(ChatConsumer, '/ws/chat/room/', self.alice, room_name='room')
+        notifications = await connect(NotificationConsumer, '/ws/notification/', self.bob)
+        await chat.send_json_to({'type': 'chat_message', 'sender': 'alice', 'recipient': 'bob', 'message': text})
+        self.assertEqual((await chat.receive_json_from())['message'], text)
+        self.assertEqual((await notifications.receive_json_from())['notification'], text)
+        await chat.disconnect()
+        await notifications.disconnect()
+
+    def test_chat_message_is_one_insert_and_one_thread_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(self.exchange)('hi')
+
+        statements = [query['sql'] for query in queries.captured_queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(statements), 2, statements)
+        self.assertTrue(statements[0].startswith('INSERT INTO "flopChat_messagemodel"'))
+        self.assertTrue(statements[1].startswith('UPDATE "flopChat_conversationmodel"'))
+
+        message = MessageModel.objects.get(content='hi')
+        self.assertTrue(message.notification_send)
+        bob_thread = ConversationModel.objects.get(owner=self.bob, partner=self.alice)
+        self.assertEqual((bob_thread.last_message_id, bob_thread.unread_count), (message.id, 1))
+
+    async def send_while_offline(self, text):
+        chat = await connect(ChatConsumer, '/ws/chat/room/', self.alice, room_name='room')
+        with mock.patch.object(ChatConsumer, 'send_chat_notification') as send_chat_notification:
+            await chat.send_json_to({'type': 'chat_message', 'sender': 'alice', 'recipient': 'bob', 'message': text})
+            self.assertEqual((await chat.receive_json_from())['message'], text)
+            await chat.disconnect()
+        send_chat_notification.assert_not_called()
+
+        notifications = await connect(NotificationConsumer, '/ws/notification/', self.bob)
+        await notifications.send_json_to({'type': 'notification'})
+        digest = await notifications.receive_json_from()
+        await notifications.disconnect()
+        return digest
+
+    def test_offline_recipient_gets_message_from_replay(self):
+        digest = async_to_sync(self.send_while_offline)('are you there?')
+
+        self.assertEqual(digest['type'], 'notification_digest')
+        self.assertEqual([(entry['sender_username'], entry['notification']) for entry in digest['senders']],
+                         [('alice', 'are you there?')])
+        self.assertTrue(MessageModel.objects.get(content='are you there?').notification_send)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class PresenceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', email='alice@example.com')
+        cls.bob = User.objects.create(username='bob', email='bob@example.com')
+
+    async def connect_twice(self):
+        first = await connect(NotificationConsumer, '/ws/notification/', self.bob)
+        second = await connect(NotificationConsumer, '/ws/notification/', self.bob)
+        online = [await presence.is_online(self.bob.id)]
+        await first.disconnect()
+        online.append(await presence.is_online(self.bob.id))
+        await second.disconnect()
+        online.append(await presence.is_online(self.bob.id))
+        return online
+
+    def test_user_stays_online_until_last_socket_closes(self):
+        self.assertEqual(async_to_sync(self.connect_twice)(), [True, True, False])
+
+    def test_presence_endpoint_is_measured(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        client.get('/chat/presence/', {'ids': self.bob.id})
+
+        with override_settings(METRICS_TOKEN='scraper'):
+            metrics = APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer scraper').content.decode()
+        self.assertIn('flop_http_request_seconds_count{route="chat/presence/",method="GET",status="200"}', metrics)
+
+    def test_metrics_are_private_by_default(self):
+        client = APIClient()
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        with override_settings(METRICS_TOKEN='scraper'):
+            self.assertEqual(client.get('/metrics').status_code, 403)
+            self.assertEqual(client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+    def test_metrics_export_cache_counters(self):
+        user_cache.clear()
+        user_cache.get_by_id(self.alice.id)
+        user_cache.set(self.alice)
+        user_cache.get_by_id(self.alice.id)
+        stats = user_cache.stats()
+
+        with override_settings(METRICS_TOKEN='scraper'):
+            metrics = APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer scraper').content.decode()
+        self.assertIn(f'flop_cache_hits_total{{cache="user"}} {stats["hits"]}', metrics)
+        self.assertIn(f'flop_cache_misses_total{{cache="user"}} {stats["misses"]}', metrics)
+        self.assertIn('flop_cache_entries{cache="user"} 1', metrics)
+        self.assertIn('flop_cache_hits_total{cache="token"}', metrics)
+
+    def test_presence_endpoint(self):
+        async_to_sync(presence.user_connected)(self.bob.id, 'specific.bob')
+        self.addCleanup(async_to_sync(presence.user_disconnected), self.bob.id, 'specific.bob')
+        client = APIClient()
+        client.force_authenticate(self.alice)
+
+        response = client.get('/chat/presence/', {'ids': f'{self.alice.id},{self.bob.id}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {str(self.alice.id): False, str(self.bob.id): True})
+        self.assertEqual(client.get('/chat/presence/', {'ids': 'bob'}).status_code, 400)
+
+
+class HandshakeAuthenticationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', email='alice@example.com')
+
+    def setUp(self):
+        token_cache.clear()
+        user_cache.clear()
+        self.token = str(AccessToken.for_user(self.alice))
+
+    async def test_concurrent_handshakes_share_one_lookup(self):
+        with mock.patch.object(middleware, 'fetch_user', wraps=middleware.fetch_user) as fetch_user:
+            users = await asyncio.gather(*(middleware.authenticate(self.token) for _ in range(20)))
+            user_cache.clear()
+            await middleware.authenticate(self.token)
+        self.assertEqual({user.id for user in users}, {self.alice.id})
+        fetch_user.assert_called_once_with(self.alice.id)
+
+    async def test_deactivation_drops_cached_token(self):
+        self.assertEqual((await middleware.authenticate(self.token)).id, self.alice.id)
+        self.alice.is_active = False
+        await self.alice.asave(update_fields=['is_active'])
+        self.assertTrue((await middleware.authenticate(self.token)).is_anonymous)
+
+    async def test_handshake_user_is_fully_loaded(self):
+        user = await middleware.authenticate(self.token)
+        self.assertIs(user_cache.get_by_id(self.alice.id), user)
+        self.assertEqual(user.get_deferred_fields(), set())
+        self.assertEqual((user.email, user.is_staff, user.last_login), ('alice@example.com', False, None))
+
+    async def test_tampered_token_is_rejected(self):
+        with self.assertRaises(jwt.InvalidTokenError):
+            await middleware.authenticate(self.token[:-2] + 'xx')
+
+
+class LocalFastPathChannelLayerTests(SimpleTestCase):
+    async def test_group_of_local_channels_skips_inner_layer(self):
+        inner = InMemoryChannelLayer()
+        layer = LocalFastPathChannelLayer(inner=inner)
+        first, second = await layer.new_channel(), await layer.new_channel()
+        await layer.group_add('chat_room', first)
+        await layer.group_add('chat_room', second)
+
+        with mock.patch.object(inner, 'group_send', wraps=inner.group_send) as inner_group_send:
+            await layer.group_send('chat_room', {'type': 'chat_message', 'message': 'hi'})
+        inner_group_send.assert_not_called()
+        self.assertEqual((await layer.receive(first))['message'], 'hi')
+        self.assertEqual((await layer.receive(second))['message'], 'hi')
+
+    async def test_group_with_remote_member_goes_through_inner_layer(self):
+        inner = InMemoryChannelLayer()
+        local_layer = LocalFastPathChannelLayer(inner=inner)
+        remote_layer = LocalFastPathChannelLayer(inner=inner)
+        local = await local_layer.new_channel()
+        remote = await remote_layer.new_channel()
+        await local_layer.group_add('chat_room', local)
+        await remote_layer.group_add('chat_room', remote)
+
+        with mock.patch.object(inner, 'group_send', wraps=inner.group_send) as inner_group_send:
+            await local_layer.group_send('chat_room', {'type': 'chat_message', 'message': 'hi'})
+        inner_group_send.assert_called_once()
+        self.assertEqual((await local_layer.receive(local))['message'], 'hi')
+        self.assertEqual((await remote_layer.receive(remote))['message'], 'hi')
+
+    async def test_remote_join_invalidates_cached_membership(self):
+        inner = InMemoryChannelLayer()
+        local_layer = LocalFastPathChannelLayer(inner=inner)
+        remote_layer = LocalFastPathChannelLayer(inner=inner)
+        local = await local_layer.new_channel()
+        await local_layer.group_add('chat_room', local)
+        await local_layer.group_send('chat_room', {'type': 'chat_message', 'message': 'first'})
+        self.assertEqual((await local_layer.receive(local))['message'], 'first')
+
+        # A connected consumer always has a receive pending, which is what picks up the invalidation.
+        pending = asyncio.ensure_future(local_layer.receive(local))
+        remote = await remote_layer.new_channel()
+        await remote_layer.group_add('chat_room', remote)
+        await asyncio.sleep(0.01)
+        await local_layer.group_send('chat_room', {'type': 'chat_message', 'message': 'second'})
+        self.assertEqual((await pending)['message'], 'second')
+        self.assertEqual((await remote_layer.receive(remote))['message'], 'second')
+
+
+TIGHT_RATE_LIMITS = {
+    'default': {'connection': (0.01, 2), 'user': (0.01, 2)},
+    'chat_message': {'connection': (100, 100), 'user': (0.01, 2)},
+}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, WS_RATE_LIMITS=TIGHT_RATE_LIMITS,
+                   WS_RATE_LIMIT_MAX_STRIKES=2)
+class RateLimitTests(SimpleTestCase):
+    async def test_user_budget_is_shared_between_connections(self):
+        store = InMemoryStore()
+        first, second = RateLimiter(store, user_id=1), RateLimiter(store, user_id=1)
+        self.assertEqual(await first.check('chat_message'), 0)
+        self.assertEqual(await second.check('chat_message'), 0)
+        self.assertGreater(await first.check('chat_message'), 0)
+        self.assertEqual(await RateLimiter(store, user_id=2).check('chat_message'), 0)
+
+    async def test_slow_down_then_close(self):
+        call = await connect(VoiceChatConsumer, '/ws/call/room/', User(id=1, username='alice'), room_name='room')
+        self.assertEqual((await call.receive_json_from())['type'], 'peer_id')
+        for _ in range(3):
+            await call.send_json_to({'type': 'ice_candidate', 'candidate': 'candidate:1'})
+        slow_down = await call.receive_json_from()
+        self.assertEqual(slow_down['type'], 'slow_down')
+        self.assertEqual(slow_down['for'], 'ice_candidate')
+        self.assertGreater(slow_down['retry_after'], 0)
+
+        await call.send_json_to({'type': 'ice_candidate', 'candidate': 'candidate:2'})
+        self.assertEqual(await call.receive_output(), {'type': 'websocket.close', 'code': RATE_LIMITED_CLOSE_CODE})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class CallSignalingTests(SimpleTestCase):
+    async def join(self, username, query=''):
+        call = await connect(VoiceChatConsumer, f'/ws/call/room/{query}', User(id=len(username), username=username),
+                             room_name='room')
+        welcome = await call.receive_json_from()
+        self.assertEqual(welcome['type'], 'peer_id')
+        return call, welcome
+
+    async def test_signaling_is_routed_to_the_addressed_peer(self):
+        alice, alice_welcome = await self.join('alice')
+        bob, bob_welcome = await self.join('bob')
+        carol, carol_welcome = await self.join('carol')
+        self.assertEqual([peer['username'] for peer in carol_welcome['peers']], ['alice', 'bob'])
+        self.assertEqual((await alice.receive_json_from())['username'], 'bob')
+        self.assertEqual((await alice.receive_json_from())['username'], 'carol')
+        self.assertEqual((await bob.receive_json_from())['username'], 'carol')
+
+        await alice.send_json_to({'type': 'offer', 'sdp': 'v=0', 'to': bob_welcome['peer_id']})
+        self.assertEqual(await bob.receive_json_from(),
+                         {'type': 'offer', 'sdp': 'v=0', 'from': alice_welcome['peer_id']})
+        self.assertTrue(await carol.receive_nothing())
+
+        await alice.send_json_to({'type': 'ice_candidate', 'candidate': 'candidate:1'})
+        self.assertEqual((await bob.receive_json_from())['candidates'], ['candidate:1'])
+        self.assertEqual((await carol.receive_json_from())['candidates'], ['candidate:1'])
+        self.assertTrue(await alice.receive_nothing())
+
+        await carol.disconnect()
+        self.assertEqual(await alice.receive_json_from(), {'type': 'peer_left', 'peer_id': carol_welcome['peer_id']})
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_candidates_are_batched_until_end_of_candidates(self):
+        alice, _ = await self.join('alice', '?ice_batch=1000')
+        bob, bob_welcome = await self.join('bob')
+        per_candidate, _ = await self.join('carol', '?ice_batch=0')
+        await alice.receive_json_from()
+        await alice.receive_json_from()
+        await bob.receive_json_from()
+
+        candidates = [f'candidate:{index}' for index in range(20)]
+        with mock.patch('channels.layers.InMemoryChannelLayer.group_send', autospec=True,
+                        side_effect=InMemoryChannelLayer.group_send) as group_send:
+            for candidate in candidates:
+                await alice.send_json_to({'type': 'ice_candidate', 'candidate': candidate})
+            self.assertTrue(await bob.receive_nothing())
+            await alice.send_json_to({'type': 'ice_candidate', 'candidate': ''})
+            batch = await bob.receive_json_from()
+        self.assertEqual(group_send.call_count, 1)
+        self.assertEqual((batch['type'], batch['candidates']), ('ice_candidates', candidates + ['']))
+        self.assertEqual([(await per_candidate.receive_json_from())['candidate'] for _ in range(21)],
+                         candidates + [''])
+
+        await alice.send_json_to({'type': 'ice_candidate', 'candidate': 'candidate:late', 'to': bob_welcome['peer_id']})
+        await alice.send_json_to({'type': 'end_of_candidates'})
+        self.assertEqual((await bob.receive_json_from())['candidates'], ['candidate:late'])
+        self.assertTrue(await per_candidate.receive_nothing())
+        for call in (alice, bob, per_candidate):
+            await call.disconnect()
+
+    async def test_late_joiner_gets_signaling_snapshot(self):
+        alice, alice_welcome = await self.join('alice', '?ice_batch=1000')
+        await alice.send_json_to({'type': 'offer', 'sdp': 'v=0 stale'})
+        await alice.send_json_to({'type': 'ice_candidate', 'candidate': 'candidate:stale'})
+        await alice.send_json_to({'type': 'offer', 'sdp': 'v=0'})
+        for index in range(3):
+            await alice.send_json_to({'type': 'ice_candidate', 'candidate': f'candidate:{index}'})
+        await alice.send_json_to({'type': 'end_of_candidates'})
+        await alice.send_json_to({'type': 'offer', 'sdp': 'v=0 for someone', 'to': 'gone'})
+        self.assertEqual(await alice.receive_json_from(), {'type': 'peer_left', 'peer_id': 'gone'})
+
+        bob, bob_welcome = await self.join('bob')
+        self.assertEqual(bob_welcome['peers'], [{
+            'peer_id': alice_welcome['peer_id'],
+            'username': 'alice',
+            'offer': 'v=0',
+            'candidates': ['candidate:0', 'candidate:1', 'candidate:2'],
+        }])
+
+        await alice.disconnect()
+        await bob.disconnect()
+        self.assertEqual(await get_store().hash_get_all(peers_key('room')), {})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_HISTORY_PAGE_SIZE=3, CHAT_HISTORY_MAX_PAGE_SIZE=5)
+class HistoryPageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', email='alice@example.com')
+        cls.bob = User.objects.create(username='bob', email='bob@example.com')
+        cls.carol = User.objects.create(username='carol', email='carol@example.com')
+        cls.ids = [
+            MessageModel.objects.create(sender=sender, receiver=receiver, content=f'message {index}').id
+            for index, (sender, receiver) in enumerate([(cls.alice, cls.bob), (cls.bob, cls.alice)] * 4)
+        ]
+        MessageModel.objects.create(sender=cls.alice, receiver=cls.carol, content='elsewhere')
+
+    def page(self, before=None, page_size=None):
+        return async_to_sync(ChatConsumer().get_history_page)(self.alice, self.bob, before, page_size)
+
+    def walk(self, page_size=None):
+        ids, before = [], None
+        while True:
+            messages, before = self.page(before, page_size)
+            self.assertEqual([message['id'] for message in messages],
+                             sorted(message['id'] for message in messages))
+            ids[:0] = [message['id'] for message in messages]
+            if before is None:
+                return ids
+
+    def test_pages_walk_the_whole_thread_once(self):
+        self.assertEqual(self.walk(), self.ids)
+        self.assertEqual(self.walk(page_size=8), self.ids)
+
+    def test_rows_with_equal_timestamps_are_neither_skipped_nor_repeated(self):
+        timestamp = MessageModel.objects.get(id=self.ids[0]).timestamp
+        MessageModel.objects.filter(id__in=self.ids).update(timestamp=timestamp)
+        self.assertEqual(self.walk(page_size=3), self.ids)
+
+    def test_page_size_is_clamped(self):
+        self.assertEqual(len(self.page(page_size=100)[0]), 5)
+        self.assertEqual(len(self.page(page_size=-1)[0]), 1)
+        self.assertEqual(len(self.page()[0]), 3)
+
+    async def request_history(self, before):
+        chat = await connect(ChatConsumer, '/ws/chat/room/', self.alice, room_name='room')
+        await chat.send_json_to({'type': 'get_history', 'sender': 'alice', 'recipient': 'bob', 'before': before})
+        frame = await chat.receive_json_from()
+        await chat.disconnect()
+        return frame
+
+    def test_invalid_cursor_is_rejected(self):
+        user_cache.clear()
+        for before in ('junk', 'not-a-date|4', '2024-01-01T00:00:00+00:00|x'):
+            frame = async_to_sync(self.request_history)(before)
+            self.assertEqual((frame['type'], frame['for']), ('error', 'get_history'))
+            self.assertIn('Invalid history cursor', frame['error'])
+
+
+class ChatListViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', email='alice@example.com', bio='alice bio')
+        cls.bob = User.objects.create(username='bob', email='bob@example.com', bio='bob bio')
+        cls.carol = User.objects.create(username='carol', email='carol@example.com')
+        cls.dave = User.objects.create(username='dave', email='dave@example.com')
+        for sender, receiver, content in [(cls.bob, cls.alice, 'from bob'), (cls.alice, cls.carol, 'to carol'),
+                                          (cls.alice, cls.alice, 'note to self'), (cls.bob, cls.dave, 'not alice')]:
+            ConversationModel.record_message(MessageModel.objects.create(sender=sender, receiver=receiver,
+                                                                         content=content))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_partner_list_holds_only_chat_partners(self):
+        response = self.client.get('/chat/users_chat/')
+        self.assertEqual(sorted(user['username'] for user in response.json()), ['bob', 'carol'])
+        self.assertEqual(self.client.get(f'/chat/users_chat/{self.dave.id}/').status_code, 404)
+
+    def test_partner_list_is_read_only(self):
+        url = f'/chat/users_chat/{self.bob.id}/'
+        self.assertEqual(self.client.get(url).json()['username'], 'bob')
+        self.assertEqual(self.client.patch(url, {'bio': 'hijacked'}, format='json').status_code, 405)
+        self.assertEqual(self.client.put(url, {'username': 'hijacked'}, format='json').status_code, 405)
+        self.assertEqual(self.client.delete(url).status_code, 405)
+        self.assertEqual(self.client.post('/chat/users_chat/', {'username': 'new'}, format='json').status_code, 405)
+
+        self.bob.refresh_from_db()
+        self.assertEqual((self.bob.username, self.bob.bio), ('bob', 'bob bio'))
+
+    def test_conversations_come_newest_first_with_unread_counts(self):
+        ConversationModel.record_message(MessageModel.objects.create(sender=self.bob, receiver=self.alice,
+                                                                     content='bob again'))
+        results = self.client.get('/chat/conversations/').json()['results']
+        self.assertEqual([(row['username'], row['last_message'], row['unread_count']) for row in results],
+                         [('bob', 'bob again', 2), ('carol', 'to carol', 0)])
+
+    def test_conversations_are_cursor_paginated(self):
+        for index in range(5):
+            partner = User.objects.create(username=f'partner_{index}', email=f'partner_{index}@example.com')
+            ConversationModel.record_message(MessageModel.objects.create(sender=partner, receiver=self.alice,
+                                                                         content=f'hi {index}'))
+        usernames = []
+        url = '/chat/conversations/?page_size=3'
+        while url:
+            page = self.client.get(url).json()
+            self.assertLessEqual(len(page['results']), 3)
+            usernames.extend(row['username'] for row in page['results'])
+            url = page['next']
+
+        self.assertEqual(usernames, [f'partner_{index}' for index in reversed(range(5))] + ['carol', 'bob'])
+
+
+class RebuildConversationsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', email='alice@example.com')
+        cls.bob = User.objects.create(username='bob', email='bob@example.com')
+        cls.carol = User.objects.create(username='carol', email='carol@example.com')
+        cls.messages = [
+            MessageModel.objects.create(sender=sender, receiver=receiver, content=content)
+            for sender, receiver, content in [(cls.alice, cls.bob, 'one'), (cls.bob, cls.alice, 'two'),
+                                              (cls.bob, cls.alice, 'three'), (cls.alice, cls.carol, 'four')]
+        ]
+        ConversationModel.record_messages(cls.messages)
+
+    def snapshot(self):
+        return {
+            (thread.owner.username, thread.partner.username): (
+                thread.last_message_id, thread.unread_count, thread.read_watermark
+            )
+            for thread in ConversationModel.objects.select_related('owner', 'partner')
+        }
+
+    def test_repairs_counters_and_missing_and_stale_threads(self):
+        expected = self.snapshot()
+        ConversationModel.objects.filter(owner=self.alice, partner=self.bob).update(unread_count=99,
+                                                                                 last_message=None)
+        ConversationModel.objects.filter(owner=self.carol).delete()
+        ConversationModel.objects.create(owner=self.bob, partner=self.carol, unread_count=3)
+
+        call_command('rebuild_conversations', stdout=StringIO())
+
+        self.assertEqual(self.snapshot(), expected)
+        self.assertEqual(expected[('alice', 'bob')], (self.messages[2].id, 2, 0))
+        self.assertEqual(expected[('carol', 'alice')], (self.messages[3].id, 1, 0))
+
+    def test_carries_legacy_read_flags_into_the_watermark(self):
+        MessageModel.objects.filter(id=self.messages[1].id).update(is_read=True)
+
+        call_command('rebuild_conversations', stdout=StringIO())
+
+        thread = ConversationModel.objects.get(owner=self.alice, partner=self.bob)
+        self.assertEqual((thread.read_watermark, thread.unread_count), (self.messages[1].id, 1))
+
+
+class BackfillConversationsMigrationTests(TransactionTestCase):
+    before = [('flopChat', '0005_conversationmodel_read_watermark')]
+    after = [('flopChat', '0006_backfill_conversations')]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_migration_summarizes_existing_messages(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        apps = executor.loader.project_state(self.before).apps
+        Message = apps.get_model('flopChat', 'MessageModel')
+        alice = apps.get_model('users', 'User').objects.create(username='alice', email='alice@example.com')
+        bob = apps.get_model('users', 'User').objects.create(username='bob', email='bob@example.com')
+        read = Message.objects.create(sender=alice, receiver=bob, content='one', is_read=True)
+        latest = Message.objects.create(sender=alice, receiver=bob, content='two')
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+
+        self.assertEqual(
+            set(ConversationModel.objects.values_list('owner', 'partner', 'last_message', 'unread_count',
+                                                      'read_watermark')),
+            {(alice.id, bob.id, latest.id, 0, 0), (bob.id, alice.id, latest.id, 1, read.id)},
+        )
+
+
+class ConversationRecordTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', email='alice@example.com')
+        cls.bob = User.objects.create(username='bob', email='bob@example.com')
+
+    def test_first_messages_sent_at_once_are_both_counted(self):
+        from_bob = MessageModel.objects.create(sender=self.bob, receiver=self.alice, content='hi alice')
+        from_alice = MessageModel.objects.create(sender=self.alice, receiver=self.bob, content='hi bob')
+        move_threads = ConversationModel._move_threads.__func__
+        calls = []
+
+        def lose_the_race(cls, threads, message, unread):
+            calls.append(message)
+            if len(calls) == 1:
+                # Bob's first message commits its threads between Alice's UPDATE and her get_or_create.
+                ConversationModel.record_message(from_bob)
+                return 0
+            return move_threads(cls, threads, message, unread)
+
+        with mock.patch.object(ConversationModel, '_move_threads', classmethod(lose_the_race)):
+            ConversationModel.record_message(from_alice)
+
+        threads = {(thread.owner_id, thread.partner_id): thread for thread in ConversationModel.objects.all()}
+        self.assertEqual(len(threads), 2)
+        for thread in threads.values():
+            self.assertEqual((thread.last_message_id, thread.last_activity), (from_alice.id, from_alice.timestamp))
+        self.assertEqual(threads[(self.alice.id, self.bob.id)].unread_count, 1)
+        self.assertEqual(threads[(self.bob.id, self.alice.id)].unread_count, 1)
+
+    def test_message_to_self_keeps_one_thread_without_unread(self):
+        ConversationModel.record_message(MessageModel.objects.create(sender=self.alice, receiver=self.alice,
+                                                                     content='note'))
+        ConversationModel.record_message(MessageModel.objects.create(sender=self.alice, receiver=self.alice,
+                                                                     content='another'))
+        thread = ConversationModel.objects.get()
+        self.assertEqual((thread.owner_id, thread.partner_id, thread.unread_count), (self.alice.id, self.alice.id, 0))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class MessageWriteBufferTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', email='alice@example.com')
+        cls.bob = User.objects.create(username='bob', email='bob@example.com')
+
+    def message(self, content):
+        return MessageModel(sender=self.alice, receiver=self.bob, content=content)
+
+    async def fill(self, buffer, contents):
+        saved = [await buffer.add(self.message(content)) for content in contents]
+        return await asyncio.wait_for(asyncio.gather(*saved), 1)
+
+    def test_full_batch_is_written_without_waiting_for_the_interval(self):
+        buffer = MessageWriteBuffer(batch_size=3, flush_interval=60, max_pending=100)
+        async_to_sync(self.fill)(buffer, ['one', 'two', 'three'])
+
+        self.assertEqual(buffer.written, 3)
+        self.assertEqual(ConversationModel.objects.get(owner=self.bob).unread_count, 3)
+
+    def test_partial_batch_is_written_after_the_interval(self):
+        buffer = MessageWriteBuffer(batch_size=100, flush_interval=0.01, max_pending=100)
+        async_to_sync(self.fill)(buffer, ['one'])
+
+        self.assertEqual(buffer.written, 1)
+        self.assertTrue(MessageModel.objects.filter(content='one').exists())
+
+    async def send_and_disconnect(self):
+        chat = await connect(ChatConsumer, '/ws/chat/room/', self.alice, room_name='room')
+        await chat.send_json_to({'type': 'chat_message', 'sender': 'alice', 'recipient': 'bob', 'message': 'bye'})
+        await chat.receive_json_from()
+        await chat.disconnect()
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_disconnect_drains_the_buffer(self):
+        user_cache.clear()
+        buffer = MessageWriteBuffer(batch_size=100, flush_interval=60, max_pending=100)
+        with mock.patch.object(consumers, 'message_buffer', buffer):
+            async_to_sync(self.send_and_disconnect)()
+
+        self.assertEqual(buffer.written, 1)
+        self.assertTrue(MessageModel.objects.filter(content='bye').exists())
+
+    async def disconnect_behind_another_write(self, buffer, released):
+        chat = await connect(ChatConsumer, '/ws/chat/room/', self.alice, room_name='room')
+        await chat.send_json_to({'type': 'chat_message', 'sender': 'alice', 'recipient': 'bob', 'message': 'bye'})
+        await chat.receive_json_from()
+        await buffer.add(self.message('other'))
+        try:
+            # The communicator cancels a consumer still running at the timeout instead of failing.
+            await chat.disconnect(timeout=1)
+            self.assertFalse(chat.future.cancelled())
+        finally:
+            released.set()
+            await buffer.flush()
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_disconnect_waits_only_for_its_own_messages(self):
+        user_cache.clear()
+        buffer = MessageWriteBuffer(batch_size=1, flush_interval=60, max_pending=100)
+        released = threading.Event()
+        write = buffer.write
+
+        def slow_write(messages):
+            # Another connection's message, stuck behind a slow write, must not hold up this disconnect.
+            if messages[0].content == 'other':
+                released.wait(5)
+            write(messages)
+
+        with mock.patch.object(consumers, 'message_buffer', buffer), mock.patch.object(buffer, 'write', slow_write):
+            async_to_sync(self.disconnect_behind_another_write)(buffer, released)
+
+        self.assertEqual(sorted(MessageModel.objects.values_list('content', flat=True)), ['bye', 'other'])
+
+    async def overflow(self, buffer):
+        # The worker holds one message while it waits, and the queue takes max_pending more.
+        for index in range(3):
+            await buffer.add(self.message(f'queued {index}'))
+        blocked = asyncio.ensure_future(buffer.add(self.message('blocked')))
+        await asyncio.sleep(0.05)
+        self.assertFalse(blocked.done())
+
+        await buffer.flush()
+        await blocked
+        await buffer.flush()
+
+    def test_add_blocks_at_max_pending(self):
+        buffer = MessageWriteBuffer(batch_size=100, flush_interval=60, max_pending=2)
+        async_to_sync(self.overflow)(buffer)
+        self.assertEqual(buffer.written, 4)
+
+    def test_failed_batch_falls_back_to_one_save_per_message(self):
+        buffer = MessageWriteBuffer(batch_size=3, flush_interval=60, max_pending=100)
+        with self.assertLogs('flopChat.buffer', 'ERROR') as logs:
+            saved = async_to_sync(self.fill)(buffer, ['one', None, 'three'])
+
+        self.assertEqual(saved, [True, False, True])
+        self.assertEqual((buffer.written, buffer.dropped), (2, 1))
+        self.assertEqual(sorted(MessageModel.objects.values_list('content', flat=True)), ['one', 'three'])
+        self.assertIn(f'from user {self.alice.id} to user {self.bob.id}', logs.output[-1])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ReadWatermarkTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', email='alice@example.com')
+        cls.bob = User.objects.create(username='bob', email='bob@example.com')
+        cls.carol = User.objects.create(username='carol', email='carol@example.com')
+        cls.read = [cls.send(cls.bob, cls.alice, 'read one'), cls.send(cls.bob, cls.alice, 'read two')]
+        cls.reply = cls.send(cls.alice, cls.bob, 'reply')
+
+    @staticmethod
+    def send(sender, receiver, content):
+        message = MessageModel.objects.create(sender=sender, receiver=receiver, content=content)
+        ConversationModel.record_message(message)
+        return message
+
+    def test_mark_read_moves_the_watermark_to_the_latest_message(self):
+        self.assertTrue(ConversationModel.mark_read(self.alice, self.bob))
+        self.assertFalse(ConversationModel.mark_read(self.alice, self.bob))
+
+        thread = ConversationModel.objects.get(owner=self.alice, partner=self.bob)
+        self.assertEqual((thread.read_watermark, thread.unread_count), (self.reply.id, 0))
+        self.assertFalse(MessageModel.objects.filter(is_read=True).exists())
+
+    def test_mark_read_creates_a_missing_thread(self):
+        ConversationModel.objects.filter(owner=self.alice).delete()
+
+        self.assertTrue(ConversationModel.mark_read(self.alice, self.bob))
+        self.assertFalse(ConversationModel.mark_read(self.alice, self.bob))
+        self.assertFalse(ConversationModel.mark_read(self.alice, self.carol))
+
+        thread = ConversationModel.objects.get(owner=self.alice)
+        self.assertEqual((thread.partner, thread.last_message_id, thread.read_watermark, thread.unread_count),
+                         (self.bob, self.reply.id, self.reply.id, 0))
+
+    def test_history_reads_is_read_from_the_watermark(self):
+        ConversationModel.mark_read(self.alice, self.bob)
+        unseen = self.send(self.bob, self.alice, 'unseen')
+
+        messages, _ = async_to_sync(ChatConsumer().get_history_page)(self.alice, self.bob)
+        self.assertEqual({message['message']: message['is_read'] for message in messages},
+                         {'read one': True, 'read two': True, 'reply': False, 'unseen': False})
+        self.assertFalse(unseen.is_read)
+
+    def test_digest_skips_read_messages_and_read_threads(self):
+        ConversationModel.mark_read(self.alice, self.bob)
+        self.send(self.bob, self.alice, 'unseen')
+        self.send(self.carol, self.alice, 'from carol')
+        self.send(self.carol, self.alice, 'carol again')
+
+        message_ids, digest = async_to_sync(NotificationConsumer().get_notification_digest)(self.alice)
+        self.assertEqual(len(message_ids), 3)
+        self.assertEqual([(entry['sender_username'], entry['count'], entry['notification']) for entry in digest],
+                         [('carol', 2, 'carol again'), ('bob', 1, 'unseen')])
+
+        ConversationModel.mark_read(self.alice, self.carol)
+        ConversationModel.mark_read(self.alice, self.bob)
+        with self.assertNumQueries(1):
+            self.assertEqual(async_to_sync(NotificationConsumer().get_notification_digest)(self.alice), ([], []))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class FrameEncodingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create(username='alice', email='alice@example.com')
+        cls.bob = User.objects.create(username='bob', email='bob@example.com')
+
+    def setUp(self):
+        user_cache.clear()
+
+    async def round_trip(self, subprotocols):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/ws/chat/room/', subprotocols=subprotocols)
+        communicator.scope['url_route'] = {'kwargs': {'room_name': 'room'}}
+        communicator.scope['user'] = self.alice
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        message = {'type': 'chat_message', 'sender': 'alice', 'recipient': 'bob', 'message': 'привет'}
+        if subprotocol == MSGPACK_SUBPROTOCOL:
+            await communicator.send_to(bytes_data=msgpack.packb(message))
+        else:
+            await communicator.send_json_to(message)
+        frame = await communicator.receive_output()
+        await communicator.disconnect()
+        return subprotocol, frame
+
+    def test_msgpack_clients_get_binary_frames(self):
+        subprotocol, frame = async_to_sync(self.round_trip)(['flop.unknown', MSGPACK_SUBPROTOCOL])
+
+        self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+        self.assertIsNone(frame.get('text'))
+        self.assertEqual(msgpack.unpackb(frame['bytes']), {
+            'message': 'привет', 'sender': 'alice', 'avatar': None, 'recipient': 'bob', 'is_read': False,
+        })
+        self.assertEqual(MessageModel.objects.get().content, 'привет')
+
+    def test_other_clients_keep_json_text_frames(self):
+        subprotocol, frame = async_to_sync(self.round_trip)(['flop.unknown'])
+
+        self.assertIsNone(subprotocol)
+        self.assertIsNone(frame.get('bytes'))
+        self.assertEqual(json.loads(frame['text'])['message'], 'привет')
+
+
+class BurstConsumer(FrameConsumer):
+    """Answers ``{"count": n}`` with n numbered frames."""
+
+    async def connect(self):
+        await self.accept()
+
+    async def receive_frame(self, content):
+        for index in range(content['count']):
+            await self.send_frame({'index': index})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class CoalescingTests(SimpleTestCase):
+    def counter(self, metric):
+        return metric.values.get(('BurstConsumer',), 0)
+
+    async def test_frames_in_one_window_arrive_as_one_ordered_array(self):
+        messages, frames = self.counter(WS_COALESCED_MESSAGES), self.counter(WS_COALESCED_FRAMES)
+        burst = await connect(BurstConsumer, '/ws/burst/?coalesce=5', User(id=1, username='alice'))
+        await burst.send_json_to({'count': 5})
+
+        self.assertEqual(await burst.receive_json_from(), [{'index': index} for index in range(5)])
+        await burst.send_json_to({'count': 2})
+        self.assertEqual(await burst.receive_json_from(), [{'index': 0}, {'index': 1}])
+        await burst.disconnect()
+
+        self.assertEqual(self.counter(WS_COALESCED_MESSAGES) - messages, 7)
+        self.assertEqual(self.counter(WS_COALESCED_FRAMES) - frames, 2)
+
+    async def test_without_coalesce_every_message_is_its_own_frame(self):
+        burst = await connect(BurstConsumer, '/ws/burst/', User(id=1, username='alice'))
+        await burst.send_json_to({'count': 2})
+
+        self.assertEqual(await burst.receive_json_from(), {'index': 0})
+        self.assertEqual(await burst.receive_json_from(), {'index': 1})
+        await burst.disconnect()
+
+    @override_settings(WS_COALESCE_MAX_QUEUE=3)
+    async def test_client_that_falls_behind_is_closed(self):
+        closes = self.counter(WS_SLOW_CONSUMER_CLOSES)
+        burst = await connect(BurstConsumer, '/ws/burst/?coalesce=5', User(id=1, username='alice'))
+        await burst.send_json_to({'count': 10})
+
+        self.assertEqual(await burst.receive_output(), {'type': 'websocket.close', 'code': SLOW_CONSUMER_CLOSE_CODE})
+        self.assertEqual(self.counter(WS_SLOW_CONSUMER_CLOSES) - closes, 1)
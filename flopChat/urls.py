@@ -6,5 +6,7 @@ routers = DefaultRouter()
 routers.register(r'users_chat', views.ChatView, basename='users_chat')
 
 urlpatterns = [
+    path('conversations/', views.ConversationView.as_view(), name='conversations'),
+    path('presence/', views.PresenceView.as_view(), name='presence'),
     path('', include(routers.urls)),
 ]
\ No newline at end of file
@@ -1,23 +1,70 @@
-from rest_framework import viewsets
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from rest_framework import generics, status, viewsets
+from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from .models import MessageModel
+from . import presence
+from .models import ConversationModel
+from .serializers import ConversationSerializer
+from users.models import User
 from users.serializers import UserSerializer
-from django.db.models import Q
 
 
-class ChatView(viewsets.ModelViewSet):
+class ChatView(viewsets.ReadOnlyModelViewSet):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = UserSerializer
 
     def get_queryset(self):
         user = self.request.user
-        messages = MessageModel.objects.filter(Q(sender=user) | Q(receiver=user)).select_related('sender', 'receiver')
-
-        users = set()
-        for message in messages:
-            users.add(message.sender)
-            users.add(message.receiver)
-        users.discard(user)
-        return list(users)
+        return User.objects.filter(
+            id__in=ConversationModel.objects.filter(owner=user).exclude(partner=user).values('partner')
+        )
+
+
+class ConversationPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('-last_activity', '-id')
+
+
+class ConversationView(generics.ListAPIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    serializer_class = ConversationSerializer
+    pagination_class = ConversationPagination
+
+    def get_queryset(self):
+        user = self.request.user
+        return ConversationModel.objects.filter(owner=user).exclude(partner=user).select_related(
+            'partner', 'last_message'
+        ).only(
+            'id', 'last_activity', 'unread_count',
+            'partner__id', 'partner__username', 'partner__avatar',
+            'last_message__content',
+        )
+
+
+class PresenceView(APIView):
+    """``GET ?ids=1,2,3`` -> ``{"1": true, "2": false, ...}``"""
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        try:
+            user_ids = list(dict.fromkeys(
+                int(user_id) for user_id in request.query_params.get('ids', '').split(',') if user_id
+            ))
+        except ValueError:
+            return Response({'detail': 'ids must be a comma-separated list of user ids.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(user_ids) > settings.PRESENCE_MAX_QUERY:
+            return Response({'detail': f'At most {settings.PRESENCE_MAX_QUERY} ids per request.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        statuses = async_to_sync(presence.online_status)(user_ids)
+        return Response({str(user_id): online for user_id, online in statuses.items()})
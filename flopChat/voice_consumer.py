@@ -1,11 +1,50 @@
+import asyncio
 import json
 import logging
-from channels.generic.websocket import AsyncWebsocketConsumer
+import secrets
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+from .protocol import FrameConsumer
+from .store import get_store
 
 logger = logging.getLogger(__name__)
 
 
-class VoiceChatConsumer(AsyncWebsocketConsumer):
+def peers_key(room_name):
+    return f'call:{room_name}:peers'
+
+
+class VoiceChatConsumer(FrameConsumer):
+    """
+    WebRTC signaling for one call room.
+
+    Every socket is given a ``peer_id`` on connect, along with the peers
+    already in the room, and is told about later ``peer_joined`` /
+    ``peer_left`` events. Offers, answers and ICE candidates that name a peer
+    in ``to`` are delivered to that peer only; without ``to`` they go to every
+    other peer in the room. Relayed frames carry the sender's id in ``from``.
+
+    ICE candidates are collected for ``ICE_BATCH_WINDOW`` seconds (or
+    ``?ice_batch=<ms>``) and relayed as one ``ice_candidates`` frame. A batch
+    goes out early on an end-of-candidates marker (an empty candidate or an
+    ``end_of_candidates`` frame), when it is full, and before any offer or
+    answer, so ordering is kept. Clients that connect with ``?ice_batch=0``
+    send and receive one ``ice_candidate`` frame per candidate.
+
+    The room roster doubles as a signaling snapshot: each peer's entry also
+    holds its latest room-wide offer and answer and the candidates gathered
+    since that offer (at most ``SIGNALING_SNAPSHOT_MAX_CANDIDATES``). A peer
+    that joins late or reconnects gets all of it in its ``peer_id`` frame and
+    can answer without a new offer round trip. Entries go when their peer
+    disconnects, and the roster with the last one; ``CALL_PEER_TTL`` covers
+    workers that die first.
+    """
+
+    peer_id = None
+    ice_batch_window = None
+    candidate_flush = None
 
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
@@ -13,148 +52,302 @@ class VoiceChatConsumer(AsyncWebsocketConsumer):
         if self.user.is_anonymous:
             await self.close()
         else:
-            self.room_group_name = f'chat_{self.room_name}'
+            self.room_group_name = f'call_{self.room_name}'
+            self.peer_id = secrets.token_urlsafe(8)
+            self.ice_batch_window = self.requested_ice_batch_window()
+            self.pending_candidates = {}
+            self.snapshot = {}
+            store = get_store(self.channel_layer)
 
+            # Join the group before reading the roster so that no peer_joined in between is missed.
             await self.channel_layer.group_add(
                 self.room_group_name,
                 self.channel_name
             )
-
             await self.accept()
-            logger.info(f"WebSocket connected for room '{self.room_name}'")
 
-    async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
+            self.peers = {
+                peer_id: json.loads(peer)
+                for peer_id, peer in (await store.hash_get_all(peers_key(self.room_name))).items()
+            }
+            await self.save_snapshot()
+            await self.send_frame({
+                'type': 'peer_id',
+                'peer_id': self.peer_id,
+                'peers': [
+                    {key: value for key, value in dict(peer, peer_id=peer_id).items() if key != 'channel'}
+                    for peer_id, peer in self.peers.items()
+                ],
+            })
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    'type': 'peer_joined',
+                    'peer_id': self.peer_id,
+                    'channel': self.channel_name,
+                    'username': self.user.username,
+                }
+            )
+            logger.info(f"WebSocket connected for room '{self.room_name}' as peer {self.peer_id}")
+
+    async def save_snapshot(self):
+        await get_store(self.channel_layer).hash_set(
+            peers_key(self.room_name),
+            self.peer_id,
+            json.dumps(dict(self.snapshot, channel=self.channel_name, username=self.user.username)),
+            settings.CALL_PEER_TTL
         )
+
+    def remember(self, key, sdp):
+        """Keep a room-wide offer or answer in the snapshot; a new offer restarts candidate gathering."""
+        if len(json.dumps(sdp)) > settings.SIGNALING_SNAPSHOT_MAX_SDP:
+            self.snapshot.pop(key, None)
+        else:
+            self.snapshot[key] = sdp
+        if key == 'offer':
+            self.snapshot['candidates'] = []
+
+    def remember_candidates(self, candidates):
+        gathered = self.snapshot.setdefault('candidates', [])
+        gathered.extend(candidates)
+        del gathered[:-settings.SIGNALING_SNAPSHOT_MAX_CANDIDATES]
+
+    def requested_ice_batch_window(self):
+        query_params = parse_qs(self.scope.get('query_string', b'').decode(), keep_blank_values=True)
+        if 'ice_batch' not in query_params:
+            return settings.ICE_BATCH_WINDOW
+        try:
+            window = float(query_params['ice_batch'][0]) / 1000
+        except ValueError:
+            window = settings.ICE_BATCH_WINDOW
+        if window <= 0:
+            return None
+        return min(window, settings.ICE_BATCH_MAX_WINDOW)
+
+    async def disconnect(self, close_code):
+        if self.peer_id is not None:
+            await self.flush_candidates()
+            await get_store(self.channel_layer).hash_delete(peers_key(self.room_name), self.peer_id)
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    'type': 'peer_left',
+                    'peer_id': self.peer_id,
+                }
+            )
+            await self.channel_layer.group_discard(
+                self.room_group_name,
+                self.channel_name
+            )
         logger.info(f"WebSocket disconnected for room '{self.room_name}' with code {close_code}")
 
-    async def receive(self, text_data):
-        logger.info(f"Получен сообщение: {text_data}")
+    async def receive_frame(self, content):
+        logger.debug("Получен сообщение: %s", content)
         try:
-            text_data_json = json.loads(text_data)
-            _type = text_data_json.get('type')
+            _type = content.get('type')
+            to = content.get('to')
             if _type == 'signal':
-                signal = text_data_json.get('signal')
+                signal = content.get('signal')
                 await self.send_signals(signal)
             elif _type == 'ice_candidate':
-                candidate = text_data_json.get('candidate')
-                await self.send_ice_candidate(candidate)
+                candidate = content.get('candidate')
+                await self.send_ice_candidate(candidate, to)
             elif _type == 'offer':
-                sdp_offer = text_data_json.get('sdp')
-                logger.info(f"Получен оффер: {sdp_offer}")
-                await self.send_offers(sdp_offer)
+                sdp_offer = content.get('sdp')
+                logger.debug("Получен оффер: %s", sdp_offer)
+                await self.send_offers(sdp_offer, to)
             elif _type == 'answer':
-                sdp_answer = text_data_json.get('sdp')
-                logger.info(f"Получен ответ: {sdp_answer}")
-                await self.send_answers(sdp_answer)
+                sdp_answer = content.get('sdp')
+                logger.debug("Получен ответ: %s", sdp_answer)
+                await self.send_answers(sdp_answer, to)
+            elif _type == 'end_of_candidates':
+                await self.flush_candidates()
         except Exception as e:
             logger.error(f"Ошибка при обработке сообщения: {e}")
 
+    async def relay(self, event, to=None):
+        event['from'] = self.peer_id
+        if to is None:
+            await self.channel_layer.group_send(self.room_group_name, event)
+            return
+
+        peer = self.peers.get(to)
+        if peer is None:
+            await self.send_frame({'type': 'peer_left', 'peer_id': to})
+            return
+        await self.channel_layer.send(peer['channel'], event)
+
+    def is_echo(self, event):
+        return event.get('from') == self.peer_id
+
+    async def peer_joined(self, event):
+        if event['peer_id'] == self.peer_id:
+            return
+        self.peers[event['peer_id']] = {'channel': event['channel'], 'username': event['username']}
+        await self.send_frame({
+            'type': 'peer_joined',
+            'peer_id': event['peer_id'],
+            'username': event['username'],
+        })
+
+    async def peer_left(self, event):
+        if event['peer_id'] == self.peer_id:
+            return
+        self.peers.pop(event['peer_id'], None)
+        await self.send_frame({
+            'type': 'peer_left',
+            'peer_id': event['peer_id'],
+        })
+
     async def send_signals(self, signal):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'signal',
-                'signal': signal if signal else None,
-            }
-        )
+        await self.relay({
+            'type': 'send_signal',
+            'signal': signal if signal else None,
+        })
 
     async def send_signal(self, event):
-        logger.info(f'Обработка сигнального сообщения: {event}')
+        logger.debug('Обработка сигнального сообщения: %s', event)
+        if self.is_echo(event):
+            return
         try:
             signal = event['signal']
-            logger.info(f'Получен сигнал: signal={signal}')
+            logger.debug('Получен сигнал: signal=%s', signal)
 
-            await self.send(json.dumps({
+            await self.send_frame({
                 'type': 'signal',
                 'signal': signal,
-            }))
+                'from': event['from'],
+            })
         except Exception as e:
             logger.error(f'Ошибка при отправке сигнала: {e}')
 
-    async def send_offers(self, sdp):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'send_offer',
-                'offer': sdp if sdp else None,
-            }
-        )
+    async def send_offers(self, sdp, to=None):
+        await self.flush_candidates()
+        if to is None:
+            self.remember('offer', sdp)
+            await self.save_snapshot()
+        await self.relay({
+            'type': 'send_offer',
+            'offer': sdp if sdp else None,
+        }, to)
 
     async def send_offer(self, event):
-        logger.info(f"Обработка оффера: {event}")
+        logger.debug("Обработка оффера: %s", event)
+        if self.is_echo(event):
+            return
         try:
             offer = event['offer']
-            logger.info(f"Получен оффер: offer={offer}")
+            logger.debug("Получен оффер: offer=%s", offer)
 
-            await self.send(json.dumps({
+            await self.send_frame({
                 'type': 'offer',
                 'sdp': offer,
-            }))
+                'from': event['from'],
+            })
         except Exception as e:
             logger.error(f"Ошибка при отправке оффера: {e}")
 
-    async def send_ice_candidate(self, candidate):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
+    async def send_ice_candidate(self, candidate, to=None):
+        if self.ice_batch_window is None:
+            if to is None:
+                self.remember_candidates([candidate])
+                await self.save_snapshot()
+            await self.relay({
                 'type': 'ice_candidate',
                 'candidate': candidate,
-            }
-        )
+            }, to)
+            return
 
-    async def send_answers(self, sdp):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'send_answer',
-                'answer': sdp if sdp else None,
-            }
-        )
+        batch = self.pending_candidates.setdefault(to, [])
+        batch.append(candidate)
+        end_of_candidates = not candidate or (isinstance(candidate, dict) and not candidate.get('candidate'))
+        if end_of_candidates or len(batch) >= settings.ICE_BATCH_MAX_CANDIDATES:
+            await self.flush_candidates()
+        elif self.candidate_flush is None:
+            self.candidate_flush = asyncio.get_running_loop().create_task(self.flush_candidates_later())
+
+    async def flush_candidates_later(self):
+        await asyncio.sleep(self.ice_batch_window)
+        self.candidate_flush = None
+        await self.flush_candidates()
+
+    async def flush_candidates(self):
+        if self.candidate_flush is not None and self.candidate_flush is not asyncio.current_task():
+            self.candidate_flush.cancel()
+            self.candidate_flush = None
+        pending, self.pending_candidates = self.pending_candidates, {}
+        if None in pending:
+            self.remember_candidates(pending[None])
+            await self.save_snapshot()
+        for to, candidates in pending.items():
+            await self.relay({
+                'type': 'ice_candidates',
+                'candidates': candidates,
+            }, to)
+
+    async def send_answers(self, sdp, to=None):
+        await self.flush_candidates()
+        if to is None:
+            self.remember('answer', sdp)
+            await self.save_snapshot()
+        await self.relay({
+            'type': 'send_answer',
+            'answer': sdp if sdp else None,
+        }, to)
 
     async def send_answer(self, event):
-        logger.info(f"Обработка ответа: {event}")
+        logger.debug("Обработка ответа: %s", event)
+        if self.is_echo(event):
+            return
         try:
             answer = event['answer']
-            logger.info(f"Получен ответ: answer={answer}")
+            logger.debug("Получен ответ: answer=%s", answer)
 
-            await self.send(json.dumps({
+            await self.send_frame({
                 'type': 'answer',
                 'sdp': answer,
-            }))
+                'from': event['from'],
+            })
         except Exception as e:
             logger.error(f"Ошибка при отправке ответа: {e}")
 
     async def ice_candidate(self, event):
-        logger.info(f"Обработка ICE кандидата: {event}")
+        logger.debug("Обработка ICE кандидата: %s", event)
+        if self.is_echo(event):
+            return
         try:
             candidate = event['candidate']
-            logger.info(f"Получен ICE кандидат: candidate={candidate}")
+            logger.debug("Получен ICE кандидат: candidate=%s", candidate)
 
-            await self.send(json.dumps({
+            await self.send_frame({
                 'type': 'ice_candidate',
                 'candidate': candidate,
-            }))
+                'from': event['from'],
+            })
         except Exception as e:
             logger.error(f"Ошибка при отправке ICE кандидата: {e}")
 
-    async def chat_message(self, event):
-        logger.info(f"Обработка сигнального сообщения: {event}")
+    async def ice_candidates(self, event):
+        logger.debug("Обработка пачки ICE кандидатов: %s", event)
+        if self.is_echo(event):
+            return
         try:
-            _type = event['type']
-            if _type == 'signal_message':
-                signal = event['signal']
-                sender = event['sender']
-                logger.info(f"Получено сигнальное сообщение: signal={signal}, sender={sender}")
-                await self.send(json.dumps({
-                    'type': 'signal_message',
-                    'signal': signal,
-                    'sender': sender,
-                }))
+            if self.ice_batch_window is None:
+                for candidate in event['candidates']:
+                    await self.send_frame({
+                        'type': 'ice_candidate',
+                        'candidate': candidate,
+                        'from': event['from'],
+                    })
+                return
+
+            await self.send_frame({
+                'type': 'ice_candidates',
+                'candidates': event['candidates'],
+                'from': event['from'],
+            })
         except Exception as e:
-            logger.error(f"Ошибка при отправке сигнального сообщения: {e}")
+            logger.error(f"Ошибка при отправке ICE кандидатов: {e}")
 
     # async def web_rtc_message(self, event):
     #     logger.info(f"Обработка сигнального сообщения: {event}")
@@ -0,0 +1,24 @@
+"""
+Support for the ``bench_*`` management commands.
+
+Benchmarks seed and churn thousands of rows, so they run against a scratch
+copy of the schema rather than the database ``DATABASE_URL`` points at.
+"""
+from contextlib import contextmanager
+
+from django.db import connections
+
+
+@contextmanager
+def throwaway_database(verbosity=0):
+    """Point every connection at a freshly migrated test database for the block, and drop it afterwards."""
+    created = []
+    try:
+        for connection in connections.all():
+            created.append((connection, connection.creation.create_test_db(
+                verbosity=verbosity, autoclobber=True, serialize=False,
+            )))
+        yield
+    finally:
+        for connection, old_name in reversed(created):
+            connection.creation.destroy_test_db(old_name, verbosity=verbosity)
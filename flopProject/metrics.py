@@ -0,0 +1,201 @@
+"""
+In-process counters, gauges and latency histograms, rendered in the Prometheus text format at ``/metrics``.
+
+Every worker process keeps its own registry, so each one is scraped separately.
+"""
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound
+
+REGISTRY = []
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        yield f'{self.name}{format_labels(self.labelnames, key)} {value}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += 1
+            state[2] += value
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def render_value(self, key, value):
+        bucket_counts, count, total = value
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            yield f'{self.name}_bucket{format_labels(self.labelnames + ("le",), key + (str(bound),))} {cumulative}'
+        yield f'{self.name}_bucket{format_labels(self.labelnames + ("le",), key + ("+Inf",))} {count}'
+        yield f'{self.name}_count{format_labels(self.labelnames, key)} {count}'
+        yield f'{self.name}_sum{format_labels(self.labelnames, key)} {total}'
+
+
+class Collector(Metric):
+    """Values read at scrape time from ``collect()``, an iterable of ``(labels, value)`` pairs."""
+
+    def __init__(self, name, documentation, labelnames, kind, collect):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.collect = collect
+
+    def render(self):
+        with self.lock:
+            self.values = {self.key(labels): value for labels, value in self.collect()}
+        return super().render()
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+WS_RECEIVE_SECONDS = Histogram('flop_ws_receive_seconds', 'Time spent handling one inbound WebSocket frame.',
+                               ('consumer', 'type'))
+WS_CONNECTIONS = Gauge('flop_ws_connections', 'Open WebSocket connections.', ('consumer',))
+DB_SECONDS = Histogram('flop_db_seconds', 'Duration of consumer database helpers.', ('helper',))
+GROUP_SEND_SECONDS = Histogram('flop_channel_layer_group_send_seconds', 'Channel layer group_send latency.',
+                               ('path',))
+WS_COALESCED_MESSAGES = Counter('flop_ws_coalesced_messages_total',
+                                'Outbound messages sent inside coalesced frames.', ('consumer',))
+WS_COALESCED_FRAMES = Counter('flop_ws_coalesced_frames_total', 'Coalesced frames sent.', ('consumer',))
+WS_COALESCE_BYTES_SAVED = Counter('flop_ws_coalesce_bytes_saved_total',
+                                  'Estimated frame header bytes saved by coalescing.', ('consumer',))
+WS_SLOW_CONSUMER_CLOSES = Counter('flop_ws_slow_consumer_closes_total',
+                                  'Coalescing connections closed for falling behind.', ('consumer',))
+HTTP_REQUEST_SECONDS = Histogram('flop_http_request_seconds', 'HTTP request latency per route.',
+                                 ('route', 'method', 'status'))
+
+
+def cache_stats(field):
+    def collect():
+        from users.cache import token_cache, user_cache
+
+        for name, cache in (('user', user_cache), ('token', token_cache)):
+            yield {'cache': name}, cache.stats()[field]
+
+    return collect
+
+
+CACHE_HITS = Collector('flop_cache_hits_total', 'Process-local user and token cache hits.', ('cache',), 'counter',
+                       cache_stats('hits'))
+CACHE_MISSES = Collector('flop_cache_misses_total', 'Process-local user and token cache misses.', ('cache',),
+                         'counter', cache_stats('misses'))
+CACHE_ENTRIES = Collector('flop_cache_entries', 'Entries held in the process-local user and token caches.',
+                          ('cache',), 'gauge', cache_stats('size'))
+
+
+def timed_db(func):
+    """Record the duration of a ``database_sync_to_async`` helper under its qualified name."""
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with DB_SECONDS.time(helper=name):
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            route=match.route if match is not None else 'unmatched',
+            method=request.method,
+            status=response.status_code,
+        )
+        return response
+
+
+def metrics_view(request):
+    token = settings.METRICS_TOKEN
+    if not token:
+        return HttpResponseNotFound()
+    if request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponseForbidden()
+    body = '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
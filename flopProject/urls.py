@@ -19,6 +19,7 @@ from django.contrib.staticfiles.views import serve
 from django.urls import path, include
 
 from flopProject import settings
+from flopProject.metrics import metrics_view
 from index import views
 
 static_and_media_urls = [
@@ -32,6 +33,7 @@ urlpatterns = [
     path('api/', include('users.urls')),
     path('flop/', include('floplegends.urls')),
     path('chat/', include('flopChat.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 urlpatterns += static_and_media_urls
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class FloplegendsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'floplegends'
+
+    def ready(self):
+        from floplegends import signals  # noqa: F401
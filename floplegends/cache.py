@@ -0,0 +1,72 @@
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+
+VERSION_KEY = 'floplegends:feed:version'
+
+
+class FeedCache:
+    """
+    Serialized pages of the public legends feed, keyed by a catalogue version.
+
+    Any change that can show up in the feed bumps the version (see
+    ``floplegends.signals``), which orphans every cached page at once; the
+    orphans age out after ``FLOP_FEED_CACHE_TIMEOUT``. The version and the
+    query string also make up the page's ETag, so a client revalidating an
+    unchanged page costs one version read.
+
+    Pages may be private to a worker, but the version lives in a cache that
+    every worker shares, so a bump in one invalidates the pages of all.
+    """
+
+    def __init__(self, alias, version_alias, timeout):
+        self.alias = alias
+        self.version_alias = version_alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @property
+    def versions(self):
+        return caches[self.version_alias]
+
+    def version(self):
+        version = self.versions.get(VERSION_KEY)
+        if version is None:
+            # Restart from the clock rather than 1 so that an evicted version never repeats an old ETag.
+            self.versions.add(VERSION_KEY, time.time_ns(), None)
+            version = self.versions.get(VERSION_KEY)
+        return version
+
+    def bump(self):
+        try:
+            self.versions.incr(VERSION_KEY)
+        except ValueError:
+            self.versions.add(VERSION_KEY, time.time_ns(), None)
+
+    def page(self, request):
+        """Return the cache key and ETag of the feed page ``request`` asks for."""
+        version = self.version()
+        # The host is part of the page: the cursor links in it are absolute URLs.
+        query = urlencode(sorted(request.query_params.items()))
+        digest = hashlib.sha1(f'{request.build_absolute_uri("/")}?{query}'.encode()).hexdigest()[:16]
+        return f'floplegends:feed:{version}:{digest}', f'"{version}-{digest}"'
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, data):
+        self.cache.set(key, data, self.timeout)
+
+    def clear(self):
+        self.cache.clear()
+
+
+feed_cache = FeedCache(
+    settings.FLOP_FEED_CACHE_ALIAS, settings.FLOP_FEED_VERSION_CACHE_ALIAS, settings.FLOP_FEED_CACHE_TIMEOUT,
+)
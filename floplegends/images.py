@@ -0,0 +1,108 @@
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+from floplegends.cache import feed_cache
+from floplegends.models import flopLegendsModel
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.FLOP_COVER_WORKERS, thread_name_prefix='flop-cover')
+    return _executor
+
+
+def schedule_cover_variants(legend):
+    """Build the cover variants of ``legend`` once the transaction that saved its cover commits."""
+    if not legend.cover:
+        return
+    pk, name = legend.pk, legend.cover.name
+
+    def submit():
+        if settings.FLOP_COVER_WORKERS:
+            get_executor().submit(run_in_worker, pk, name)
+        else:
+            build_cover_variants(pk, name)
+
+    transaction.on_commit(submit)
+
+
+def discard_cover_variants(variants):
+    """Delete the files of ``variants``, a replaced cover's ``cover_variants``, once the replacement commits."""
+    names = [variant['name'] for variant in variants.values()]
+    if not names:
+        return
+
+    def submit():
+        if settings.FLOP_COVER_WORKERS:
+            get_executor().submit(delete_cover_files, names)
+        else:
+            delete_cover_files(names)
+
+    transaction.on_commit(submit)
+
+
+def delete_cover_files(names):
+    storage = flopLegendsModel._meta.get_field('cover').storage
+    for name in names:
+        try:
+            storage.delete(name)
+        except Exception as e:
+            logger.error(f"Could not delete cover variant {name}: {e}")
+
+
+def run_in_worker(pk, name):
+    close_old_connections()
+    try:
+        build_cover_variants(pk, name)
+    finally:
+        close_old_connections()
+
+
+def build_cover_variants(pk, name):
+    """
+    Write a resized WebP copy of cover ``name`` for every ``FLOP_COVER_VARIANTS`` box and record them.
+
+    The record is only written while ``name`` is still the legend's cover, so a
+    slow build never overwrites the variants of a newer upload.
+    """
+    storage = flopLegendsModel._meta.get_field('cover').storage
+    try:
+        with storage.open(name, 'rb') as original:
+            image = ImageOps.exif_transpose(Image.open(original))
+            image.load()
+    except Exception as e:
+        logger.error(f"Could not read cover {name}: {e}")
+        return
+
+    image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    stem = posixpath.splitext(posixpath.basename(name))[0]
+    variants = {}
+    for variant, box in settings.FLOP_COVER_VARIANTS.items():
+        resized = image.copy()
+        resized.thumbnail(box, Image.LANCZOS)
+        buffer = BytesIO()
+        resized.save(buffer, 'WEBP', quality=settings.FLOP_COVER_WEBP_QUALITY, method=4)
+        variants[variant] = {
+            'name': storage.save(f'covers/variants/{stem}-{variant}.webp', ContentFile(buffer.getvalue())),
+            'width': resized.width,
+            'height': resized.height,
+        }
+
+    # update() skips post_save, so the feed is invalidated here.
+    if flopLegendsModel.objects.filter(pk=pk, cover=name).update(cover_variants=variants):
+        feed_cache.bump()
+    else:
+        for variant in variants.values():
+            storage.delete(variant['name'])
@@ -0,0 +1,95 @@
+import json
+import random
+import time
+from itertools import accumulate
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+
+from floplegends.models import flopLegendsModel
+from floplegends.search import search
+from flopProject.benchmarks import throwaway_database
+
+SYLLABLES = ('ka', 'lo', 'mir', 'ten', 'vas', 'dre', 'gon', 'sa', 'fli', 'pu', 'ron', 'el', 'zu', 'bar', 'ni')
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000
+
+    return {'p50_ms': at(0.50), 'p95_ms': at(0.95), 'max_ms': samples[-1] * 1000}
+
+
+class Command(BaseCommand):
+    help = ('Compare the full-text search index with an icontains scan over a synthetic catalogue '
+            'of legends, loaded into a throwaway test database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100_000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--vocabulary', type=int, default=50_000, help='Distinct words in the catalogue.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        words = sorted({''.join(rng.choices(SYLLABLES, k=rng.randint(2, 5))) for _ in range(options['vocabulary'])})
+        rng.shuffle(words)
+        # Word frequencies follow Zipf's law, as in natural text; queries pick any word of the vocabulary.
+        cum_weights = list(accumulate(1 / rank for rank in range(1, len(words) + 1)))
+        queries = [self.query(rng, words) for _ in range(options['queries'])]
+
+        def text(low, high):
+            return ' '.join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(low, high)))
+
+        with throwaway_database():
+            started = time.perf_counter()
+            flopLegendsModel.objects.bulk_create(
+                (flopLegendsModel(title=text(2, 6), description=text(20, 60)) for _ in range(options['rows'])),
+                batch_size=2000,
+            )
+            load_seconds = time.perf_counter() - started
+            results = {
+                'vendor': connection.vendor,
+                'rows': options['rows'],
+                'queries': len(queries),
+                'load_seconds': load_seconds,
+                'index': self.measure(queries, lambda terms: search(terms, options['page_size'] + 1)),
+                'icontains': self.measure(queries, lambda terms: self.scan(terms, options['page_size'] + 1)),
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+        self.stdout.write(f"{results['rows']} legends on {results['vendor']}, {results['queries']} queries "
+                          f"(loaded in {load_seconds:.1f}s)")
+        for mode in ('index', 'icontains'):
+            row = results[mode]
+            self.stdout.write(f"{mode:>10}: p50 {row['p50_ms']:8.2f}ms  p95 {row['p95_ms']:8.2f}ms  "
+                              f"max {row['max_ms']:8.2f}ms")
+        self.stdout.write(f"{'speedup':>10}: {results['icontains']['p50_ms'] / results['index']['p50_ms']:8.1f}x at p50")
+
+    def query(self, rng, words):
+        terms = rng.sample(words, rng.choice((1, 1, 2)))
+        # A third of the queries are still being typed: the last word is only a prefix.
+        if rng.random() < 1 / 3:
+            terms[-1] = terms[-1][:3]
+        return terms
+
+    def scan(self, terms, limit):
+        matches = flopLegendsModel.objects.all()
+        for term in terms:
+            matches = matches.filter(Q(title__icontains=term) | Q(description__icontains=term))
+        return list(matches.order_by('-id').values_list('id', flat=True)[:limit])
+
+    def measure(self, queries, run):
+        samples = []
+        for terms in queries:
+            started = time.perf_counter()
+            run(terms)
+            samples.append(time.perf_counter() - started)
+        return percentiles(samples)
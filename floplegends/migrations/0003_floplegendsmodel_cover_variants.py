@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 15:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('floplegends', '0002_floplegendsmodel_cover'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='floplegendsmodel',
+            name='cover_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,78 @@
+from django.db import migrations
+
+# The index lives outside the model: a generated tsvector column on PostgreSQL, an external-content
+# FTS5 table kept in step by triggers on SQLite. Other backends get neither and search with icontains.
+# A later migration that makes SQLite rebuild the legends table drops the triggers and must recreate them.
+POSTGRESQL_FORWARDS = [
+    """
+    ALTER TABLE floplegends_floplegendsmodel ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(description, '')), 'B')
+    ) STORED
+    """,
+    'CREATE INDEX floplegends_search_vector_gin ON floplegends_floplegendsmodel USING GIN (search_vector)',
+]
+POSTGRESQL_BACKWARDS = [
+    'DROP INDEX IF EXISTS floplegends_search_vector_gin',
+    'ALTER TABLE floplegends_floplegendsmodel DROP COLUMN IF EXISTS search_vector',
+]
+
+SQLITE_FORWARDS = [
+    """
+    CREATE VIRTUAL TABLE floplegends_search USING fts5(
+        title, description,
+        content='floplegends_floplegendsmodel', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER floplegends_search_insert AFTER INSERT ON floplegends_floplegendsmodel BEGIN
+        INSERT INTO floplegends_search (rowid, title, description) VALUES (new.id, new.title, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER floplegends_search_delete AFTER DELETE ON floplegends_floplegendsmodel BEGIN
+        INSERT INTO floplegends_search (floplegends_search, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER floplegends_search_update AFTER UPDATE OF title, description ON floplegends_floplegendsmodel
+    BEGIN
+        INSERT INTO floplegends_search (floplegends_search, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO floplegends_search (rowid, title, description) VALUES (new.id, new.title, new.description);
+    END
+    """,
+    "INSERT INTO floplegends_search (floplegends_search) VALUES ('rebuild')",
+]
+SQLITE_BACKWARDS = [
+    'DROP TRIGGER IF EXISTS floplegends_search_update',
+    'DROP TRIGGER IF EXISTS floplegends_search_delete',
+    'DROP TRIGGER IF EXISTS floplegends_search_insert',
+    'DROP TABLE IF EXISTS floplegends_search',
+]
+
+STATEMENTS = {
+    'postgresql': (POSTGRESQL_FORWARDS, POSTGRESQL_BACKWARDS),
+    'sqlite': (SQLITE_FORWARDS, SQLITE_BACKWARDS),
+}
+
+
+def run(direction):
+    def operation(apps, schema_editor):
+        for statement in STATEMENTS.get(schema_editor.connection.vendor, ([], []))[direction]:
+            schema_editor.execute(statement)
+
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('floplegends', '0003_floplegendsmodel_cover_variants'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(0), run(1)),
+    ]
@@ -7,6 +7,8 @@ class flopLegendsModel(models.Model):
     title = models.CharField(max_length=100)
     description = models.TextField()
     cover = models.ImageField(upload_to='covers', null=True, blank=True)
+    # Resized WebP copies of the cover by variant name, filled in by floplegends.images.
+    cover_variants = models.JSONField(default=dict, blank=True)
     creator = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
 
     def __str__(self):
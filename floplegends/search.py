@@ -0,0 +1,72 @@
+"""
+Full-text search over legend titles and descriptions.
+
+Each word of the query must match the start of a word in the title or the
+description; title matches rank higher. Results come best first, ties broken
+by newest, as ``(id, score)`` pairs so that callers can page with the last
+pair as a keyset cursor.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from floplegends.models import flopLegendsModel
+
+WORD = re.compile(r'\w+')
+MAX_TERMS = 8
+
+SQLITE_SEARCH = """
+    SELECT id, score FROM (
+        SELECT rowid AS id, -bm25(floplegends_search, 10.0, 1.0) AS score
+        FROM floplegends_search
+        WHERE floplegends_search MATCH %s
+    )
+    WHERE score < %s OR (score = %s AND id < %s)
+    ORDER BY score DESC, id DESC
+    LIMIT %s
+"""
+
+# Cast to float8 so that a score read back from a cursor compares equal to the one in the index.
+POSTGRESQL_SEARCH = """
+    SELECT id, score FROM (
+        SELECT id, ts_rank(search_vector, to_tsquery('simple', %s))::float8 AS score
+        FROM floplegends_floplegendsmodel
+        WHERE search_vector @@ to_tsquery('simple', %s)
+    ) AS matches
+    WHERE score < %s OR (score = %s AND id < %s)
+    ORDER BY score DESC, id DESC
+    LIMIT %s
+"""
+
+
+def search_terms(query):
+    return WORD.findall(query.lower())[:MAX_TERMS]
+
+
+def search(terms, limit, after=None):
+    """Return up to ``limit`` ``(id, score)`` pairs matching every term, starting after the pair ``after``."""
+    if not terms:
+        return []
+    score, last_id = after if after is not None else (float('inf'), float('inf'))
+
+    if connection.vendor == 'sqlite':
+        match = ' '.join(f'"{term}"*' for term in terms)
+        return run(SQLITE_SEARCH, [match, score, score, last_id, limit])
+    if connection.vendor == 'postgresql':
+        query = ' & '.join(f'{term}:*' for term in terms)
+        return run(POSTGRESQL_SEARCH, [query, query, score, score, last_id, limit])
+
+    # No index on this backend: every match scores 0 and comes newest first.
+    matches = flopLegendsModel.objects.all()
+    for term in terms:
+        matches = matches.filter(Q(title__icontains=term) | Q(description__icontains=term))
+    if after is not None:
+        matches = matches.filter(id__lt=last_id)
+    return [(id, 0.0) for id in matches.order_by('-id').values_list('id', flat=True)[:limit]]
+
+
+def run(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [(id, score) for id, score in cursor.fetchall()]
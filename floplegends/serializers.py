@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import flopLegendsModel
 
@@ -5,18 +6,32 @@ from .models import flopLegendsModel
 class flopLegendsSerializer(serializers.ModelSerializer):
     creator_username = serializers.SerializerMethodField()
     creator_avatar = serializers.SerializerMethodField()
+    cover_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = flopLegendsModel
-        fields = ['id', 'title', 'description', 'cover', 'creator', 'creator_username', 'creator_avatar']
+        fields = ['id', 'title', 'description', 'cover', 'cover_srcset', 'creator', 'creator_username',
+                  'creator_avatar']
 
     def get_creator_username(self, obj):
-        return obj.creator.username
+        if obj.creator:
+            return obj.creator.username
 
     def get_creator_avatar(self, obj):
-        if obj.creator.avatar:
+        if obj.creator and obj.creator.avatar:
             return obj.creator.avatar.url
 
+    def get_cover_srcset(self, obj):
+        """Map each cover variant to its URL, falling back to the original until the variants are built."""
+        if not obj.cover:
+            return None
+        storage = obj.cover.storage
+        srcset = {}
+        for variant in settings.FLOP_COVER_VARIANTS:
+            built = obj.cover_variants.get(variant)
+            srcset[variant] = storage.url(built['name']) if built else obj.cover.url
+        return srcset
+
 
 class CreateflopLegendsSerializer(serializers.ModelSerializer):
     class Meta:
@@ -34,3 +49,18 @@ class CreateflopLegendsSerializer(serializers.ModelSerializer):
             creator=creator
         )
         return flop
+
+
+class BatchOperationSerializer(serializers.Serializer):
+    """One item of a batch: ``create`` needs a title and description, ``update`` and ``delete`` an id."""
+    op = serializers.ChoiceField(choices=('create', 'update', 'delete'))
+    id = serializers.IntegerField(required=False)
+    title = serializers.CharField(max_length=100, required=False)
+    description = serializers.CharField(required=False)
+
+    def validate(self, attrs):
+        required = ('title', 'description') if attrs['op'] == 'create' else ('id',)
+        missing = {field: ['This field is required.'] for field in required if field not in attrs}
+        if missing:
+            raise serializers.ValidationError(missing)
+        return attrs
@@ -0,0 +1,22 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from floplegends.cache import feed_cache
+from floplegends.models import flopLegendsModel
+from users.models import User
+
+# The creator columns the feed shows next to each legend.
+FEED_USER_FIELDS = {'username', 'avatar'}
+
+
+@receiver([post_save, post_delete], sender=flopLegendsModel)
+def bump_feed_on_legend_change(sender, instance, **kwargs):
+    feed_cache.bump()
+
+
+@receiver(post_save, sender=User)
+def bump_feed_on_creator_change(sender, instance, created, update_fields=None, **kwargs):
+    # A new user has no legends yet, and saves such as last_login updates name their fields.
+    if created or (update_fields is not None and not FEED_USER_FIELDS & set(update_fields)):
+        return
+    feed_cache.bump()
@@ -1,3 +1,358 @@
-from django.test import TestCase
+import json
+from io import BytesIO
 
-# Create your tests here.
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework.test import APIClient
+
+from floplegends.cache import FeedCache, feed_cache
+from floplegends.images import build_cover_variants
+from floplegends.models import flopLegendsModel
+from users.models import User
+
+
+class AllflopLegendsViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        creators = [
+            User.objects.create(username=f'creator_{index}', email=f'creator_{index}@example.com')
+            for index in range(3)
+        ]
+        flopLegendsModel.objects.bulk_create([
+            flopLegendsModel(title=f'legend {index}', description='...', creator=creators[index % 3])
+            for index in range(30)
+        ] + [flopLegendsModel(title='orphan', description='...')])
+
+    def setUp(self):
+        feed_cache.clear()
+        feed_cache.version()
+
+    def test_page_is_one_query_whatever_its_size(self):
+        client = APIClient()
+        for page_size in (5, 25):
+            # The feed version read, then the page itself.
+            with self.assertNumQueries(2):
+                response = client.get('/flop/all/', {'page_size': page_size})
+            self.assertEqual(len(response.json()['results']), page_size)
+
+    def test_cursor_walks_the_whole_feed_newest_first(self):
+        client = APIClient()
+        ids = []
+        url = '/flop/all/?page_size=7'
+        while url:
+            page = client.get(url).json()
+            ids.extend(legend['id'] for legend in page['results'])
+            url = page['next']
+
+        self.assertEqual(ids, list(flopLegendsModel.objects.order_by('-id').values_list('id', flat=True)))
+        orphan = client.get('/flop/all/', {'page_size': 1}).json()['results'][0]
+        self.assertEqual((orphan['title'], orphan['creator_username']), ('orphan', None))
+
+
+class FeedCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.creator = User.objects.create(username='creator', email='creator@example.com')
+        flopLegendsModel.objects.bulk_create([
+            flopLegendsModel(title=f'legend {index}', description='...', creator=cls.creator)
+            for index in range(5)
+        ])
+
+    def setUp(self):
+        feed_cache.clear()
+        self.client = APIClient()
+
+    def test_repeated_page_is_served_from_the_cache(self):
+        first = self.client.get('/flop/all/', {'page_size': 3})
+        with self.assertNumQueries(1):
+            second = self.client.get('/flop/all/', {'page_size': 3})
+
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertNotEqual(self.client.get('/flop/all/', {'page_size': 4})['ETag'], first['ETag'])
+
+    def test_unchanged_page_revalidates_with_304(self):
+        etag = self.client.get('/flop/all/')['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get('/flop/all/', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_if_none_match_compares_whole_etags(self):
+        etag = self.client.get('/flop/all/')['ETag']
+        for header in (f'"stale", {etag}', f'W/{etag}', '*'):
+            self.assertEqual(self.client.get('/flop/all/', HTTP_IF_NONE_MATCH=header).status_code, 304, header)
+        for header in (etag[1:-2], f'"{etag}"', f'"x{etag[1:]}', ''):
+            self.assertEqual(self.client.get('/flop/all/', HTTP_IF_NONE_MATCH=header).status_code, 200, header)
+
+    def test_legend_changes_invalidate_every_page(self):
+        etag = self.client.get('/flop/all/')['ETag']
+        legend = flopLegendsModel.objects.create(title='fresh', description='...', creator=self.creator)
+
+        response = self.client.get('/flop/all/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['title'], 'fresh')
+
+        etag = response['ETag']
+        legend.delete()
+        self.assertNotEqual(self.client.get('/flop/all/')['ETag'], etag)
+
+    def test_bump_in_another_worker_invalidates_local_pages(self):
+        etag = self.client.get('/flop/all/')['ETag']
+        # Another worker keeps its pages elsewhere but shares the version.
+        FeedCache('default', settings.FLOP_FEED_VERSION_CACHE_ALIAS, settings.FLOP_FEED_CACHE_TIMEOUT).bump()
+
+        response = self.client.get('/flop/all/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_only_feed_visible_user_changes_invalidate(self):
+        etag = self.client.get('/flop/all/')['ETag']
+        self.creator.save(update_fields=['last_login'])
+        User.objects.create(username='newcomer', email='newcomer@example.com')
+        self.assertEqual(self.client.get('/flop/all/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.creator.username = 'renamed'
+        self.creator.save(update_fields=['username'])
+        response = self.client.get('/flop/all/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['creator_username'], 'renamed')
+
+
+IN_MEMORY_STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.InMemoryStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+def png_upload(name='cover.png', size=(1600, 900)):
+    buffer = BytesIO()
+    Image.new('RGB', size, 'orange').save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+@override_settings(STORAGES=IN_MEMORY_STORAGES, FLOP_COVER_WORKERS=0,
+                   FLOP_COVER_VARIANTS={'thumb': (320, 320), 'card': (960, 960)})
+class CoverVariantTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.creator = User.objects.create(username='creator', email='creator@example.com')
+
+    def setUp(self):
+        feed_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.creator)
+
+    def test_variants_are_built_after_the_upload_commits(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post('/flop/create/', {'title': 'legend', 'description': '...', 'cover': png_upload()},
+                             format='multipart')
+        legend = flopLegendsModel.objects.get()
+        self.assertEqual(legend.cover_variants, {})
+        srcset = self.client.get('/flop/all/').json()['results'][0]['cover_srcset']
+        self.assertEqual(srcset, {'thumb': legend.cover.url, 'card': legend.cover.url})
+
+        for callback in callbacks:
+            callback()
+
+        legend.refresh_from_db()
+        self.assertEqual({name: (variant['width'], variant['height'])
+                          for name, variant in legend.cover_variants.items()},
+                         {'thumb': (320, 180), 'card': (960, 540)})
+        with legend.cover.storage.open(legend.cover_variants['thumb']['name']) as thumb:
+            self.assertEqual(Image.open(thumb).format, 'WEBP')
+        srcset = self.client.get('/flop/all/').json()['results'][0]['cover_srcset']
+        self.assertEqual(srcset, {name: legend.cover.storage.url(variant['name'])
+                                  for name, variant in legend.cover_variants.items()})
+
+    def test_replacing_the_cover_drops_stale_variants(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/flop/create/', {'title': 'legend', 'description': '...', 'cover': png_upload()},
+                             format='multipart')
+        legend = flopLegendsModel.objects.get()
+        old_cover = legend.cover.name
+        old_variants = [variant['name'] for variant in legend.cover_variants.values()]
+        storage = legend.cover.storage
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.patch(f'/flop/update/{legend.id}/', {'cover': png_upload('new.png', (200, 400))},
+                              format='multipart')
+        legend.refresh_from_db()
+        self.assertEqual(legend.cover_variants, {})
+        # The old files go only once the replacement commits.
+        self.assertTrue(all(storage.exists(name) for name in old_variants))
+
+        # A build for the replaced cover finishing late must not record its variants.
+        build_cover_variants(legend.id, old_cover)
+        legend.refresh_from_db()
+        self.assertEqual(legend.cover_variants, {})
+
+        for callback in callbacks:
+            callback()
+        legend.refresh_from_db()
+        thumb = legend.cover_variants['thumb']
+        self.assertEqual((thumb['width'], thumb['height']), (160, 320))
+        self.assertFalse(any(storage.exists(name) for name in old_variants))
+        self.assertTrue(all(storage.exists(variant['name']) for variant in legend.cover_variants.values()))
+
+
+class SearchflopLegendsViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.creator = User.objects.create(username='creator', email='creator@example.com')
+        cls.in_title = flopLegendsModel.objects.create(title='Dragon rider', description='...', creator=cls.creator)
+        cls.in_description = flopLegendsModel.objects.create(
+            title='Night flight', description='A dragon crosses the sea', creator=cls.creator)
+        flopLegendsModel.objects.create(title='Unrelated', description='Nothing here', creator=cls.creator)
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def titles(self, query, **params):
+        return [legend['title'] for legend in self.client.get('/flop/search/', {'q': query, **params}).json()['results']]
+
+    def test_ranks_title_matches_first_and_matches_prefixes(self):
+        self.assertEqual(self.titles('dragon'), ['Dragon rider', 'Night flight'])
+        self.assertEqual(self.titles('DRAG'), ['Dragon rider', 'Night flight'])
+        self.assertEqual(self.titles('dragon sea'), ['Night flight'])
+        self.assertEqual(self.titles('griffin'), [])
+        self.assertEqual(self.titles(''), [])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.in_title.title = 'Griffin rider'
+        self.in_title.save()
+        self.in_description.delete()
+        flopLegendsModel.objects.create(title='Dragonfly', description='...', creator=self.creator)
+
+        self.assertEqual(self.titles('dragon'), ['Dragonfly'])
+        self.assertEqual(self.titles('griff'), ['Griffin rider'])
+
+    def test_keyset_pages_cover_every_match_once(self):
+        flopLegendsModel.objects.bulk_create([
+            flopLegendsModel(title=f'Saga {index}', description='saga ' * (index % 4 + 1), creator=self.creator)
+            for index in range(23)
+        ])
+        ids = []
+        url = '/flop/search/?q=saga&page_size=5'
+        while url:
+            with self.assertNumQueries(2):
+                page = self.client.get(url).json()
+            ids.extend(legend['id'] for legend in page['results'])
+            url = page['next']
+
+        self.assertEqual(sorted(ids), sorted(flopLegendsModel.objects.filter(title__startswith='Saga')
+                                             .values_list('id', flat=True)))
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(self.client.get('/flop/search/', {'q': 'saga', 'cursor': 'junk'}).status_code, 404)
+
+
+class BatchflopLegendsViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.creator = User.objects.create(username='creator', email='creator@example.com')
+        cls.other = User.objects.create(username='other', email='other@example.com')
+        cls.mine = flopLegendsModel.objects.create(title='mine', description='...', creator=cls.creator)
+        cls.doomed = flopLegendsModel.objects.create(title='doomed', description='...', creator=cls.creator)
+        cls.theirs = flopLegendsModel.objects.create(title='theirs', description='...', creator=cls.other)
+
+    def setUp(self):
+        feed_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.creator)
+
+    def test_applies_every_operation_and_reports_per_item(self):
+        etag = self.client.get('/flop/all/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/flop/batch/', [
+                {'op': 'create', 'title': 'new', 'description': '...'},
+                {'op': 'update', 'id': self.mine.id, 'title': 'renamed'},
+                {'op': 'delete', 'id': self.doomed.id},
+            ], format='json')
+
+        self.assertEqual(response.status_code, 200)
+        created = flopLegendsModel.objects.get(title='new')
+        self.assertEqual(response.json(), [
+            {'op': 'create', 'id': created.id, 'status': 201},
+            {'op': 'update', 'id': self.mine.id, 'status': 200},
+            {'op': 'delete', 'id': self.doomed.id, 'status': 204},
+        ])
+        self.assertEqual(created.creator, self.creator)
+        self.mine.refresh_from_db()
+        self.assertEqual((self.mine.title, self.mine.description), ('renamed', '...'))
+        self.assertFalse(flopLegendsModel.objects.filter(id=self.doomed.id).exists())
+        self.assertEqual(self.client.get('/flop/all/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_query_count_does_not_grow_with_the_batch(self):
+        def batch(size):
+            legends = flopLegendsModel.objects.bulk_create([
+                flopLegendsModel(title=f'item {index}', description='...', creator=self.creator)
+                for index in range(size)
+            ])
+            return [{'op': 'create', 'title': f'new {index}', 'description': '...'} for index in range(size)] + [
+                {'op': 'update', 'id': legend.id, 'description': 'updated'} for legend in legends]
+
+        queries = []
+        for size in (2, 20):
+            operations = batch(size)
+            with CaptureQueriesContext(connection) as captured:
+                self.assertEqual(self.client.post('/flop/batch/', operations, format='json').status_code, 200)
+            queries.append(len(captured))
+        self.assertEqual(queries[0], queries[1])
+
+    def test_one_bad_item_rejects_the_whole_batch(self):
+        response = self.client.post('/flop/batch/', [
+            {'op': 'create', 'title': 'new', 'description': '...'},
+            {'op': 'create', 'title': 'no description'},
+            {'op': 'rename', 'id': self.mine.id},
+        ], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([set(error) for error in response.json()], [set(), {'description'}, {'op'}])
+
+        response = self.client.post('/flop/batch/', [
+            {'op': 'create', 'title': 'new', 'description': '...'},
+            {'op': 'update', 'id': self.theirs.id, 'title': 'hijacked'},
+            {'op': 'delete', 'id': self.mine.id},
+            {'op': 'delete', 'id': self.mine.id},
+        ], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([set(error) for error in response.json()], [set(), {'id'}, set(), {'id'}])
+
+        self.assertFalse(flopLegendsModel.objects.filter(title='new').exists())
+        self.assertTrue(flopLegendsModel.objects.filter(id=self.mine.id).exists())
+        self.theirs.refresh_from_db()
+        self.assertEqual(self.theirs.title, 'theirs')
+
+
+@override_settings(STORAGES=IN_MEMORY_STORAGES, FLOP_COVER_WORKERS=0)
+class BatchCreateflopLegendsViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.creator = User.objects.create(username='creator', email='creator@example.com')
+
+    def test_creates_legends_with_their_covers(self):
+        client = APIClient()
+        client.force_authenticate(self.creator)
+        items = [
+            {'title': 'with cover', 'description': '...', 'cover': 'first'},
+            {'title': 'without cover', 'description': '...'},
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post('/flop/batch/create/', {'items': json.dumps(items), 'first': png_upload()},
+                                   format='multipart')
+
+        self.assertEqual(response.status_code, 201)
+        with_cover, without_cover = (flopLegendsModel.objects.get(id=item['id']) for item in response.json())
+        self.assertTrue(with_cover.cover.storage.exists(with_cover.cover.name))
+        self.assertEqual(set(with_cover.cover_variants), {'thumb', 'card'})
+        self.assertFalse(without_cover.cover)
+
+        response = client.post('/flop/batch/create/', {
+            'items': json.dumps([{'title': 'missing file', 'description': '...', 'cover': 'absent'}]),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()[0]), {'cover'})
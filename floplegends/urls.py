@@ -5,5 +5,8 @@ urlpatterns = [
     path('create/', views.CreateflopLegendsView.as_view(), name='create'),
     path('update/<int:id>/', views.UpdateflopLegendsView.as_view(), name='update'),
     path('delete/<int:id>/', views.DeleteflopLegendsView.as_view(), name='delete'),
+    path('batch/', views.BatchflopLegendsView.as_view(), name='batch'),
+    path('batch/create/', views.BatchCreateflopLegendsView.as_view(), name='batch-create'),
     path('all/', views.AllflopLegendsView.as_view(), name='all'),
+    path('search/', views.SearchflopLegendsView.as_view(), name='search'),
 ]
\ No newline at end of file
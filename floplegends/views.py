@@ -1,11 +1,22 @@
-from rest_framework import generics, permissions
-from rest_framework.exceptions import NotFound
+import base64
+import json
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.http import parse_etags
+from rest_framework import generics, permissions, status
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import CursorPagination
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
+from floplegends.cache import feed_cache
+from floplegends.images import discard_cover_variants, schedule_cover_variants
 from floplegends.models import flopLegendsModel
-from floplegends.serializers import CreateflopLegendsSerializer, flopLegendsSerializer
+from floplegends.search import search, search_terms
+from floplegends.serializers import BatchOperationSerializer, CreateflopLegendsSerializer, flopLegendsSerializer
 
 
 # Create your views here.
@@ -19,7 +30,8 @@ class CreateflopLegendsView(generics.CreateAPIView):
     def perform_create(self, serializer):
         creator = self.request.user
         cover = self.request.data.get('cover')
-        serializer.save(creator=creator, cover=cover)
+        legend = serializer.save(creator=creator, cover=cover)
+        schedule_cover_variants(legend)
 
 
 class UpdateflopLegendsView(generics.RetrieveUpdateAPIView):
@@ -51,7 +63,13 @@ class UpdateflopLegendsView(generics.RetrieveUpdateAPIView):
         if obj.creator == self.request.user:
             serializer = self.get_serializer(obj, data=request.data, partial=True)
             serializer.is_valid(raise_exception=True)
-            serializer.save()
+            if 'cover' in serializer.validated_data:
+                # The old variants no longer match; the original stands in until the new ones are built.
+                discard_cover_variants(obj.cover_variants)
+                legend = serializer.save(cover_variants={})
+                schedule_cover_variants(legend)
+            else:
+                serializer.save()
             return Response(serializer.data)
         return Response({"error": "You do not have permission to perform this action."}, status=403)
 
@@ -87,7 +105,190 @@ class DeleteflopLegendsView(generics.DestroyAPIView):
         return Response({"error": "You do not have permission to perform this action."}, status=403)
 
 
+class BatchflopLegendsView(generics.GenericAPIView):
+    """
+    Apply a list of create, update and delete operations in one transaction.
+
+    The whole batch is validated first, including a single ownership query for
+    every id it names; if any item fails, nothing is written and the 400 body
+    lists the errors per item. Otherwise the writes go out as one
+    ``bulk_create``, one ``bulk_update`` and one delete, and each item gets its
+    id and status back, in order.
+    """
+    authentication_classes = (JWTAuthentication,)
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = BatchOperationSerializer
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data, many=True, allow_empty=False,
+                                         max_length=settings.FLOP_BATCH_MAX_ITEMS)
+        serializer.is_valid(raise_exception=True)
+        operations = serializer.validated_data
+
+        with transaction.atomic():
+            ids = [operation['id'] for operation in operations if operation['op'] != 'create']
+            owned = flopLegendsModel.objects.select_for_update().filter(id__in=ids, creator=request.user).in_bulk()
+            errors = [{} for _ in operations]
+            seen = set()
+            for index, operation in enumerate(operations):
+                if operation['op'] == 'create':
+                    continue
+                if operation['id'] not in owned:
+                    errors[index] = {'id': ['No object found with the given ID.']}
+                elif operation['id'] in seen:
+                    errors[index] = {'id': ['This ID appears more than once in the batch.']}
+                seen.add(operation['id'])
+            if any(errors):
+                raise ValidationError(errors)
+
+            created = flopLegendsModel.objects.bulk_create([
+                flopLegendsModel(title=operation['title'], description=operation['description'], creator=request.user)
+                for operation in operations if operation['op'] == 'create'
+            ])
+            updated = []
+            for operation in operations:
+                if operation['op'] == 'update':
+                    legend = owned[operation['id']]
+                    for field in ('title', 'description'):
+                        if field in operation:
+                            setattr(legend, field, operation[field])
+                    updated.append(legend)
+            if updated:
+                flopLegendsModel.objects.bulk_update(updated, ['title', 'description'])
+            deleted = [operation['id'] for operation in operations if operation['op'] == 'delete']
+            if deleted:
+                flopLegendsModel.objects.filter(id__in=deleted).delete()
+            # bulk_create and bulk_update send no post_save, so the feed is invalidated here.
+            transaction.on_commit(feed_cache.bump)
+
+        created = iter(created)
+        statuses = {
+            'create': status.HTTP_201_CREATED,
+            'update': status.HTTP_200_OK,
+            'delete': status.HTTP_204_NO_CONTENT,
+        }
+        return Response([
+            {
+                'op': operation['op'],
+                'id': next(created).id if operation['op'] == 'create' else operation['id'],
+                'status': statuses[operation['op']],
+            }
+            for operation in operations
+        ])
+
+
+class BatchCreateflopLegendsView(generics.GenericAPIView):
+    """
+    Multipart batch create, for legends with covers.
+
+    ``items`` is a JSON list of ``{"title", "description", "cover"}`` objects
+    whose ``cover`` names the file part holding that legend's cover image.
+    """
+    authentication_classes = (JWTAuthentication,)
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = CreateflopLegendsSerializer
+    parser_classes = (MultiPartParser, FormParser)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            items = json.loads(request.data.get('items', ''))
+        except ValueError:
+            items = None
+        if not isinstance(items, list):
+            raise ValidationError({'items': ['Expected a JSON list of legends.']})
+        for item in items:
+            if isinstance(item, dict) and isinstance(item.get('cover'), str):
+                item['cover'] = request.FILES.get(item['cover'], item['cover'])
+
+        serializer = self.get_serializer(data=items, many=True, allow_empty=False,
+                                         max_length=settings.FLOP_BATCH_MAX_ITEMS)
+        serializer.is_valid(raise_exception=True)
+
+        with transaction.atomic():
+            # Covers are uploaded to storage as each row is prepared for the INSERT.
+            created = flopLegendsModel.objects.bulk_create([
+                flopLegendsModel(creator=request.user, **item) for item in serializer.validated_data
+            ])
+            for legend in created:
+                schedule_cover_variants(legend)
+            transaction.on_commit(feed_cache.bump)
+
+        return Response([{'op': 'create', 'id': legend.id, 'status': status.HTTP_201_CREATED} for legend in created],
+                        status=status.HTTP_201_CREATED)
+
+
+class flopLegendsPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-id'
+
+
+FEED_QUERYSET = flopLegendsModel.objects.select_related('creator').only(
+    'id', 'title', 'description', 'cover', 'cover_variants',
+    'creator__id', 'creator__username', 'creator__avatar',
+)
+
+
+def etag_matches(etag, if_none_match):
+    # If-None-Match uses weak comparison: a proxy that recompresses the page may have sent W/"...".
+    etags = parse_etags(if_none_match)
+    return '*' in etags or etag.removeprefix('W/') in {tag.removeprefix('W/') for tag in etags}
+
+
 class AllflopLegendsView(generics.ListAPIView):
     permission_classes = (permissions.AllowAny,)
     serializer_class = flopLegendsSerializer
-    queryset = flopLegendsModel.objects.all()
+    pagination_class = flopLegendsPagination
+    queryset = FEED_QUERYSET
+
+    def list(self, request, *args, **kwargs):
+        key, etag = feed_cache.page(request)
+        if etag_matches(etag, request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        data = feed_cache.get(key)
+        if data is None:
+            data = super().list(request, *args, **kwargs).data
+            feed_cache.set(key, data)
+        return Response(data, headers={'ETag': etag})
+
+
+class SearchflopLegendsView(generics.GenericAPIView):
+    """
+    Ranked prefix search: ``?q=word pre`` matches legends containing a word and a word starting with "pre".
+
+    Pages follow the feed's shape; ``next`` carries the score and id of the
+    last result, so each page is one index lookup however deep it is.
+    """
+    permission_classes = (permissions.AllowAny,)
+    serializer_class = flopLegendsSerializer
+    queryset = FEED_QUERYSET
+
+    def get(self, request, *args, **kwargs):
+        paginator = flopLegendsPagination()
+        page_size = paginator.get_page_size(request)
+        matches = search(search_terms(request.query_params.get('q', '')), page_size + 1, self.get_cursor())
+
+        legends = self.get_queryset().in_bulk([id for id, _ in matches[:page_size]])
+        results = [legends[id] for id, _ in matches[:page_size] if id in legends]
+        next_url = None
+        if len(matches) > page_size:
+            id, score = matches[page_size - 1]
+            cursor = base64.urlsafe_b64encode(json.dumps([score, id]).encode()).decode()
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', cursor)
+        return Response({
+            'next': next_url,
+            'previous': None,
+            'results': self.get_serializer(results, many=True).data,
+        })
+
+    def get_cursor(self):
+        encoded = self.request.query_params.get('cursor')
+        if encoded is None:
+            return None
+        try:
+            score, id = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            return float(score), int(id)
+        except (TypeError, ValueError):
+            raise NotFound('Invalid cursor')
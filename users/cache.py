@@ -0,0 +1,147 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class UserCache:
+    """
+    Process-local LRU of ``User`` rows keyed by id, with a username index.
+
+    Entries expire after ``ttl`` seconds so that saves made by other worker
+    processes (which only invalidate their own cache) are picked up eventually.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._ids_by_username = {}
+        self._lock = threading.Lock()
+
+    def get_by_id(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._discard(user_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def get_by_username(self, username):
+        user_id = self._ids_by_username.get(username)
+        if user_id is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return self.get_by_id(user_id)
+
+    def set(self, user):
+        with self._lock:
+            self._discard(user.pk)
+            self._entries[user.pk] = (time.monotonic() + self.ttl, user)
+            self._ids_by_username[user.username] = user.pk
+            while len(self._entries) > self.max_size:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._ids_by_username.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def _discard(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None and self._ids_by_username.get(entry[1].username) == user_id:
+            del self._ids_by_username[entry[1].username]
+
+
+user_cache = UserCache(settings.USER_CACHE_MAX_SIZE, settings.USER_CACHE_TTL)
+
+
+class TokenCache:
+    """
+    Process-local LRU of verified JWTs, keyed by the token's SHA-256 digest.
+
+    Each entry holds the decoded claims and the user the token resolved to, and
+    expires at the token's ``exp``. Entries for a user are dropped with
+    ``invalidate_user`` when the account is deactivated or deleted.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._digests_by_user = {}
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """``(claims, user, loaded_at)`` for a cached token, or ``None``."""
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    self._discard(digest)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return entry[1:]
+
+    def set(self, token, claims, user):
+        if 'exp' not in claims:
+            return
+        digest = self._digest(token)
+        with self._lock:
+            self._discard(digest)
+            self._entries[digest] = (claims['exp'], claims, user, time.monotonic())
+            self._digests_by_user.setdefault(user.pk, set()).add(digest)
+            while len(self._entries) > self.max_size:
+                self._discard(next(iter(self._entries)))
+
+    def discard(self, token):
+        with self._lock:
+            self._discard(self._digest(token))
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for digest in list(self._digests_by_user.get(user_id, ())):
+                self._discard(digest)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._digests_by_user.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def _discard(self, digest):
+        entry = self._entries.pop(digest, None)
+        if entry is not None:
+            digests = self._digests_by_user.get(entry[2].pk)
+            digests.discard(digest)
+            if not digests:
+                del self._digests_by_user[entry[2].pk]
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+
+token_cache = TokenCache(settings.WS_TOKEN_CACHE_MAX_SIZE)